@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable, Callable
+
+
+class BackgroundTask:
+    """Tarefa unica de longa duracao acordada por notify().
+
+    O app chama start() no seu event loop ao iniciar; dai em diante notify()
+    vindo de outra thread so agenda o aviso naquele loop. Sem start() (uso
+    fora do app) a tarefa e criada no loop do primeiro notify(), e recriada
+    se aquele loop foi fechado.
+    """
+    def __init__(self, run: Callable[[asyncio.Event], Awaitable[None]]):
+        self.run = run
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def notify(self):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if self.task is not None and not self.task.done():
+            loop = self.task.get_loop()
+            if loop is running:
+                self.wakeup.set()
+                return
+            try:
+                loop.call_soon_threadsafe(self.wakeup.set)
+                return
+            except RuntimeError:
+                # o loop da tarefa foi fechado
+                pass
+
+        if running is None:
+            return
+        self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        self.task = running.create_task(self.run(self.wakeup))
+
+    def start(self):
+        """Prende a tarefa ao event loop atual, descartando a de outro loop"""
+        loop = asyncio.get_running_loop()
+        if self.task is not None and not self.task.done() and self.task.get_loop() is loop:
+            return
+        self.stop()
+        self.wakeup = asyncio.Event()
+        # processa o que chegou antes do start
+        self.wakeup.set()
+        self.task = loop.create_task(self.run(self.wakeup))
+
+    def stop(self):
+        task, self.task = self.task, None
+        if task is None or task.done():
+            return
+        try:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+        except RuntimeError:
+            # o loop da tarefa foi fechado
+            pass
@@ -0,0 +1,66 @@
+"""Latencia de POST /api/cadastro/{cpf} conforme o numero de cpfs ja cadastrados.
+
+Uso: python bench_cadastro.py [max_cpfs] [amostras]
+Roda com um DATA_DIR temporario; STORAGE=sqlite mede o armazenamento SQLite.
+Cada linha mede a partir de exatamente "cadastrados" cpfs; linhas que as
+amostras das anteriores ja ultrapassaram sao puladas.
+"""
+import asyncio, os, sys, tempfile, time
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_cadastro_"))
+
+from httpx import ASGITransport, AsyncClient
+
+from config import ordem_turmas
+from main import app, limites
+from storage import storage
+
+# toda a carga sai do mesmo endereco
+limites.endereco = None
+
+PREFILL_BATCH = 1000
+
+
+async def prefill(start: int, end: int):
+    for batch in range(start, end, PREFILL_BATCH):
+        await asyncio.gather(*[
+            storage.cadastro(str(i), ordem_turmas) for i in range(batch, min(batch + PREFILL_BATCH, end))
+        ])
+
+
+async def main(max_cpfs: int, samples: int):
+    checkpoints = []
+    n = 1
+    while n <= max_cpfs:
+        checkpoints.append(n)
+        n *= 10
+
+    print(f"{'cadastrados':>12} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    next_cpf = 0
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://bench") as ac:
+        for checkpoint in checkpoints:
+            registered = storage.count_alunos()
+            if registered > checkpoint:
+                # as amostras das linhas anteriores ja passaram deste ponto
+                continue
+            await prefill(next_cpf, next_cpf + checkpoint - registered)
+            next_cpf += checkpoint - registered
+
+            latencies = []
+            for i in range(samples):
+                begin = time.perf_counter()
+                response = await ac.post(f"/api/cadastro/{next_cpf}")
+                latencies.append(time.perf_counter() - begin)
+                assert response.status_code == 201
+                next_cpf += 1
+
+            latencies.sort()
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000
+            print(f"{checkpoint:>12} {p50:>10.3f} {p99:>10.3f}")
+
+
+if __name__ == "__main__":
+    max_cpfs = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    asyncio.run(main(max_cpfs, samples))
@@ -0,0 +1,77 @@
+"""Tempo de TurnoManager.check() admitindo de uma vez N clientes na fila.
+
+Uso: python bench_check.py [clientes] [repeticoes]
+Cadastra N cpfs (N vagas) num DATA_DIR temporario, enfileira N clientes com
+sockets que nao fazem nada e mede um check() que admite todos. Mede tambem
+uma chamada de get_*_capacity, que le a capacidade guardada em model.Turno,
+contra recalcular a partir das turmas.
+"""
+import asyncio, os, sys, tempfile, time
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_check_"))
+
+from config import ordem_turmas
+from connection import ClientConnection, ConnectionManager
+from model import AlunoStatus, Turno, vagas, get_turnos_capacity, turno_capacity_fn
+from storage import storage
+
+
+class NullSocket:
+    async def send_text(self, data: str):
+        pass
+
+
+def recalcular(turno: Turno) -> tuple[int, int]:
+    return sum(t.verde for t in turno.turmas), min((t.verde for t in turno.turmas if t.verde != 0), default=0)
+
+
+async def bench_check(clientes: int) -> float:
+    manager = ConnectionManager()
+    turno = manager.turno
+    for i in range(clientes):
+        client = ClientConnection(socket=NullSocket(), cpf=str(i))
+        turno.queue.append(client)
+        turno.status[client] = AlunoStatus.WAITING
+
+    begin = time.perf_counter()
+    await turno.check()
+    duracao = time.perf_counter() - begin
+    assert turno.choosing == min(clientes, await get_turnos_capacity())
+    manager.deadlines.runner.stop()
+    return duracao
+
+
+async def bench_capacity(chamadas: int) -> tuple[float, float]:
+    get_capacity = turno_capacity_fn(next(iter(vagas.turnos)))
+    begin = time.perf_counter()
+    for _ in range(chamadas):
+        await get_turnos_capacity()
+        await get_capacity()
+    guardada = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    for _ in range(chamadas):
+        for turno in vagas.turnos.values():
+            recalcular(turno)
+    recalculada = time.perf_counter() - begin
+    return guardada / chamadas, recalculada / chamadas
+
+
+async def main(clientes: int, repeticoes: int):
+    storage.load()
+    if storage.count_alunos() < clientes:
+        await storage.cadastro_lote([f"bench{i}" for i in range(clientes)], ordem_turmas)
+
+    tempos = sorted([await bench_check(clientes) for _ in range(repeticoes)])
+    mediana = tempos[len(tempos) // 2]
+    print(f"check() admitindo {clientes} clientes: {mediana * 1000:.2f} ms "
+          f"({mediana / clientes * 1e6:.2f} us por admissao, mediana de {repeticoes})")
+
+    guardada, recalculada = await bench_capacity(100_000)
+    print(f"capacidade guardada: {guardada * 1e6:.3f} us, recalculada: {recalculada * 1e6:.3f} us por chamada")
+
+
+if __name__ == "__main__":
+    clientes = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    repeticoes = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    asyncio.run(main(clientes, repeticoes))
@@ -0,0 +1,173 @@
+"""Carga do fluxo de matricula: N alunos em websockets simultaneos contra um uvicorn no mesmo processo.
+
+Uso: python bench_matricula.py [alunos] [--pensar S] [--queda P] [--resultados arquivo]
+Cadastra os cpfs por POST /api/cadastro e cada aluno segue turno -> um dos turnos
+configurados -> turma:X, esperando ate --pensar segundos antes de cada comando. Com probabilidade
+--queda o aluno derruba o socket enquanto espera na fila e reconecta com o mesmo cpf.
+Mostra p50/p99 de cada comando, admissoes por segundo e confere as vagas no fim;
+cada execucao e acrescentada em --resultados e comparada com a anterior de mesmos
+parametros. Para milhares de alunos aumente o limite de arquivos (ulimit -n).
+"""
+import argparse, asyncio, json, os, random, socket, sys, tempfile, time
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_matricula_"))
+
+import httpx, uvicorn, websockets
+
+from config import turnos
+from main import app, limites
+from model import vagas
+
+
+# toda a carga sai do mesmo endereco
+limites.endereco = None
+
+
+class Aluno:
+    def __init__(self, url: str, cpf: str, pensar: float, queda: float):
+        self.url = url
+        self.cpf = cpf
+        self.pensar = pensar
+        self.queda = queda
+        self.latencias: dict[str, list[float]] = {}
+        self.espera = 0.0
+        self.quedas = 0
+        self.turma: str | None = None
+
+    async def receive(self, ws) -> str:
+        while True:
+            message = await ws.recv()
+            if not message.startswith("posicao:"):
+                return message
+
+    async def command(self, ws, command: str) -> str:
+        await asyncio.sleep(random.uniform(0, self.pensar))
+        begin = time.perf_counter()
+        await ws.send(command)
+        reply = await self.receive(ws)
+        self.latencias.setdefault(command.split(":")[0], []).append(time.perf_counter() - begin)
+        return reply
+
+    async def wait_vez(self, ws):
+        """Espera a vez; pode cair no meio e voltar pela reconexao"""
+        begin = time.perf_counter()
+        while True:
+            if random.random() < self.queda:
+                await ws.close()
+                self.quedas += 1
+                await asyncio.sleep(random.uniform(0, self.pensar))
+                ws = await websockets.connect(self.url)
+            message = await self.receive(ws)
+            if message == "vez":
+                self.espera += time.perf_counter() - begin
+                return ws
+
+    async def run(self):
+        ws = await websockets.connect(self.url)
+        try:
+            assert await self.command(ws, "turno") == "ok"
+            ws = await self.wait_vez(ws)
+
+            escolhas = list(turnos.items())
+            random.shuffle(escolhas)
+            for turno, turmas in escolhas:
+                if await self.command(ws, turno) == "ok":
+                    break
+            else:
+                return
+            ws = await self.wait_vez(ws)
+
+            for turma in turmas:
+                if await self.command(ws, f"turma:{turma}") == "ok":
+                    self.turma = turma
+                    return
+        finally:
+            await ws.close()
+
+
+def percentil(values: list[float], p: int) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * p // 100)] * 1000
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def main(args):
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", ws_max_queue=1024))
+    serve = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    cpfs = [str(i) for i in range(args.alunos)]
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+        response = await client.post("/api/cadastro", content="\n".join(cpfs))
+        assert response.json()["cadastrados"] == args.alunos, response.text
+    capacidade = {t.name: t.verde for turno in vagas.turnos.values() for t in turno.turmas}
+
+    alunos = [Aluno(f"ws://127.0.0.1:{port}/ws/matricula/{cpf}", cpf, args.pensar, args.queda) for cpf in cpfs]
+    begin = time.perf_counter()
+    erros = await asyncio.gather(*[aluno.run() for aluno in alunos], return_exceptions=True)
+    duracao = time.perf_counter() - begin
+
+    server.should_exit = True
+    await serve
+
+    latencias: dict[str, list[float]] = {}
+    for aluno in alunos:
+        for command, values in aluno.latencias.items():
+            latencias.setdefault(command, []).extend(values)
+    escolhas = [aluno.turma for aluno in alunos]
+    consistente = all(
+        t.verde + t.vermelho == capacidade[t.name] and t.vermelho == escolhas.count(t.name)
+        for turno in vagas.turnos.values() for t in turno.turmas
+    )
+    resultado = {
+        "quando": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "alunos": args.alunos, "pensar": args.pensar, "queda": args.queda,
+        "duracao_s": round(duracao, 3),
+        "admissoes_por_segundo": round(args.alunos / duracao, 1),
+        "matriculados": len([e for e in escolhas if e is not None]),
+        "falhas": len([e for e in erros if isinstance(e, BaseException)]),
+        "quedas": sum(aluno.quedas for aluno in alunos),
+        "espera_vez_p50_ms": round(percentil([a.espera for a in alunos], 50), 3),
+        "espera_vez_p99_ms": round(percentil([a.espera for a in alunos], 99), 3),
+        "comandos": {
+            command: {"p50_ms": round(percentil(values, 50), 3), "p99_ms": round(percentil(values, 99), 3)}
+            for command, values in sorted(latencias.items())
+        },
+        "vagas_consistentes": consistente,
+    }
+
+    anterior = None
+    if os.path.exists(args.resultados):
+        with open(args.resultados) as f:
+            for line in f:
+                run = json.loads(line)
+                if (run["alunos"], run["pensar"], run["queda"]) == (args.alunos, args.pensar, args.queda):
+                    anterior = run
+    with open(args.resultados, "a") as f:
+        f.write(json.dumps(resultado) + "\n")
+
+    print(f"{args.alunos} alunos em {duracao:.2f}s, {resultado['admissoes_por_segundo']} admissoes/s, "
+          f"{resultado['matriculados']} matriculados, {resultado['falhas']} falhas, {resultado['quedas']} quedas")
+    print(f"{'comando':>12} {'p50 (ms)':>10} {'p99 (ms)':>10} {'p99 antes':>10}")
+    for command, values in resultado["comandos"].items():
+        antes = "" if anterior is None or command not in anterior["comandos"] else f"{anterior['comandos'][command]['p99_ms']:.3f}"
+        print(f"{command:>12} {values['p50_ms']:>10.3f} {values['p99_ms']:>10.3f} {antes:>10}")
+    print(f"vagas consistentes: {consistente}")
+    if not consistente or resultado["falhas"] > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("alunos", type=int, nargs="?", default=1000)
+    parser.add_argument("--pensar", type=float, default=0.05, help="espera maxima antes de cada comando (s)")
+    parser.add_argument("--queda", type=float, default=0.05, help="probabilidade de cair enquanto espera a vez")
+    parser.add_argument("--resultados", default="bench_results.jsonl")
+    asyncio.run(main(parser.parse_args()))
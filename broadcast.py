@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import asyncio, json
+from dataclasses import dataclass, field
+
+from fastapi import WebSocket
+
+from background import BackgroundTask
+from config import VAGAS_BROADCAST_INTERVAL
+from model import Vagas, vagas
+from timers import monotonic
+
+
+def vagas_snapshot(vagas: Vagas) -> dict[str, int]:
+    return {t.name: t.verde for turno in vagas.turnos.values() for t in turno.turmas}
+
+
+@dataclass(eq=False)
+class Subscriber:
+    socket: WebSocket
+    sent: dict[str, int] = field(default_factory=dict)
+    next_send: float = 0.0
+    sending: bool = False
+
+
+class VagasBroadcaster:
+    """Envia as vagas de cada turma para quem assinou /ws/vagas.
+
+    Cada assinante recebe no maximo uma mensagem por intervalo, com so as
+    turmas que mudaram desde a ultima que ele recebeu; mudancas dentro do
+    intervalo sao agrupadas. Um cliente lento tem no maximo um envio em
+    andamento e recebe depois a diferenca acumulada.
+    """
+    def __init__(self, vagas: Vagas = vagas, interval: float = VAGAS_BROADCAST_INTERVAL):
+        self.vagas = vagas
+        self.interval = interval
+        self.subscribers: set[Subscriber] = set()
+        self.last: dict[str, int] = {}
+        self.sends: set[asyncio.Task] = set()
+        self.runner = BackgroundTask(self.run)
+
+    def notify(self):
+        if len(self.subscribers) > 0:
+            self.runner.notify()
+
+    async def subscribe(self, socket: WebSocket) -> Subscriber:
+        await asyncio.to_thread(self.vagas.refresh)
+        subscriber = Subscriber(socket=socket, sent=vagas_snapshot(self.vagas), next_send=monotonic() + self.interval)
+        self.subscribers.add(subscriber)
+        await socket.send_text(json.dumps({"vagas": subscriber.sent}))
+        self.runner.notify()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def run(self, wakeup: asyncio.Event):
+        timeout = None
+        while True:
+            if self.vagas.source is not None and len(self.subscribers) > 0:
+                # as vagas tambem mudam em outros workers: rele o banco a cada intervalo
+                timeout = self.interval if timeout is None else min(timeout, self.interval)
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            if self.vagas.source is not None:
+                await asyncio.to_thread(self.vagas.refresh)
+            timeout = self.broadcast()
+
+    def broadcast(self) -> float | None:
+        """Envia o que mudou; devolve em quantos segundos ha assinantes esperando o proprio intervalo"""
+        now = monotonic()
+        current = vagas_snapshot(self.vagas)
+        previous = self.last
+        if current != previous:
+            self.last = current
+        shared = None
+        retry = None
+        for subscriber in list(self.subscribers):
+            if subscriber.sending or subscriber.sent is self.last:
+                continue
+            if subscriber.next_send > now:
+                wait = subscriber.next_send - now
+                retry = wait if retry is None else min(retry, wait)
+                continue
+
+            if subscriber.sent is previous:
+                # caso comum: o assinante estava em dia e recebe a mesma mensagem que os outros
+                if shared is None:
+                    shared = json.dumps({"vagas": {name: verde for name, verde in self.last.items() if previous.get(name) != verde}})
+                message = shared
+            else:
+                delta = {name: verde for name, verde in self.last.items() if subscriber.sent.get(name) != verde}
+                if len(delta) == 0:
+                    subscriber.sent = self.last
+                    continue
+                message = json.dumps({"vagas": delta})
+
+            subscriber.sending = True
+            subscriber.next_send = now + self.interval
+            task = asyncio.create_task(self.send(subscriber, message, self.last))
+            self.sends.add(task)
+            task.add_done_callback(self.sends.discard)
+        return retry
+
+    async def send(self, subscriber: Subscriber, message: str, current: dict[str, int]):
+        try:
+            await subscriber.socket.send_text(message)
+            subscriber.sent = current
+        except Exception:
+            self.unsubscribe(subscriber)
+            return
+        finally:
+            subscriber.sending = False
+        if subscriber.sent is not self.last:
+            # as vagas mudaram de novo enquanto o envio estava em andamento
+            self.runner.notify()
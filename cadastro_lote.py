@@ -0,0 +1,40 @@
+"""Cadastra em lote os cpfs de um arquivo: array JSON ou um cpf por linha.
+
+Uso: python cadastro_lote.py alunos.txt
+Escreve direto no armazenamento, entao deve rodar com o servidor parado,
+antes de abrir as matriculas. Com o servidor no ar use POST /api/cadastro.
+"""
+import asyncio, sys
+
+from config import ordem_turmas
+from storage import storage
+from utils import cpf_valido, cpfs_from_json
+
+
+def read_cpfs(path: str) -> tuple[list[str], list]:
+    with open(path, "r") as f:
+        content = f.read()
+    if content.lstrip().startswith("["):
+        return cpfs_from_json(content)
+    return [line.strip() for line in content.split("\n") if line.strip() != ""], []
+
+
+async def main(path: str):
+    storage.load()
+    cpfs, invalidos = read_cpfs(path)
+    invalidos += [cpf for cpf in cpfs if not cpf_valido(cpf)]
+    cadastrados, duplicados = await storage.cadastro_lote([cpf for cpf in cpfs if cpf_valido(cpf)], ordem_turmas)
+    await storage.compact()
+
+    print(f"cadastrados: {cadastrados}")
+    for cpf in duplicados:
+        print(f"duplicado: {cpf}")
+    for cpf in invalidos:
+        print(f"invalido: {cpf}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1]))
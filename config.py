@@ -1,18 +1,86 @@
-import os
+import json, os
 
-matutino   = ["A", "B", "C", "D"]
-vespertino = ["E", "F", "G", "H"]
-ordem_turmas = ["A", "B", "C", "D",
-                "E", "F", "G", "H"]
+
+def load_turnos(path: str | None) -> tuple[dict[str, list[str]], list[str]]:
+    """Turnos e turmas de um JSON {"turnos": {"matutino": ["A", ...], ...}, "ordem_turmas": [...]}.
+
+    ordem_turmas e o rodizio dos cadastros; sem ela sao todas as turmas na
+    ordem dos turnos. Sem arquivo fica o curso original, A-D de manha e E-H a tarde.
+    """
+    if path is None:
+        content = {"turnos": {"matutino": ["A", "B", "C", "D"], "vespertino": ["E", "F", "G", "H"]}}
+    else:
+        with open(path, "r") as f:
+            content = json.load(f)
+
+    turnos = content["turnos"]
+    todas = [turma for turmas in turnos.values() for turma in turmas]
+    ordem = content.get("ordem_turmas", todas)
+    for nome in turnos:
+        # o nome do turno e um comando do websocket e o nome do arquivo das vagas
+        if not nome.isidentifier() or nome in ["turno", "turma", "posicao", "aluno", "journal", "estado"]:
+            raise ValueError(f"nome de turno invalido: {nome}")
+    for turma in todas:
+        if not turma.isalnum() or turma == "X":
+            raise ValueError(f"nome de turma invalido: {turma}")
+    if len(set(todas)) != len(todas):
+        raise ValueError("uma turma aparece em mais de um turno")
+    if len(ordem) == 0 or not set(ordem) <= set(todas):
+        raise ValueError("ordem_turmas deve ter somente turmas configuradas")
+    return turnos, ordem
+
+# TURNOS_FILE: JSON com os turnos e turmas do curso
+turnos, ordem_turmas = load_turnos(os.environ.get("TURNOS_FILE"))
 
 TURMA_CHOOSE_TIME = 60
 TURNO_CHOOSE_TIME = 60
+# segundos entre os envios de "posicao:N eta:S" para quem esta esperando
+POSICAO_TICK_TIME = 2
+# um cliente que cai mantem o lugar nas filas se reconectar com o mesmo cpf dentro deste prazo;
+# as mensagens enviadas nesse meio tempo (no maximo RECONNECT_BUFFER) sao reenviadas
+RECONNECT_GRACE_TIME = 15
+RECONNECT_BUFFER = 100
+# mensagens esperando envio por conexao; com a fila cheia o cliente e tratado como lento:
+# "drop" descarta a mensagem de posicao mais antiga e so desconecta se nao houver nenhuma,
+# "disconnect" desconecta logo. Um cliente desconectado pode reconectar e recebe o que ficou na fila
+OUTBOX_LIMIT = 64
+SLOW_CONSUMER_POLICY = "drop"
 
 SEP = os.path.sep
 DIR_PATH = os.path.dirname(os.path.realpath(__file__)) + SEP
-DATA_DIR = DIR_PATH + "data" + SEP
+DATA_DIR = os.environ.get("DATA_DIR", DIR_PATH + "data") + SEP
 ALUNO_DIR = DATA_DIR + "aluno" + SEP
 
 
-MATUTINO_FILE_PATH = DATA_DIR + "matutino"
-VESPERTINO_FILE_PATH = DATA_DIR + "vespertino"
+JOURNAL_FILE_PATH = DATA_DIR + "journal"
+JOURNAL_COMPACT_RECORDS = 1000
+
+# filas, status e prazos gravados ao desligar e retomados ao iniciar, para um deploy nao derrubar quem esta na fila
+ESTADO_FILE_PATH = DATA_DIR + "estado"
+
+# "local": um unico processo; "sqlite": varios workers (uvicorn --workers N)
+# compartilhando filas e status em um banco SQLite em modo WAL; exige STORAGE=sqlite
+COORDINATION = os.environ.get("COORDINATION", "local")
+COORDINATION_DB_PATH = DATA_DIR + "coordination.sqlite"
+COORDINATION_POLL_TIME = 0.05
+COORDINATION_WORKER_TIMEOUT = 10
+# segundos esperando o lock de escrita do banco antes de desistir
+COORDINATION_BUSY_TIMEOUT = 2
+
+# "file": snapshot em arquivos por cpf + journal; "sqlite": um banco SQLite indexado por cpf
+STORAGE = os.environ.get("STORAGE", "file")
+
+# um diretorio por curso, com os dados e um turnos.json opcional, servido em /{curso}/...;
+# o curso e carregado no primeiro acesso e descarregado depois de CURSO_IDLE_TIME segundos sem uso
+CURSOS_DIR = DATA_DIR + "cursos" + SEP
+CURSO_IDLE_TIME = 300
+
+# verificados antes do app, sem ler o armazenamento: tentativas por segundo e rajada por cpf
+# (/api/cadastro/{cpf} e /ws/matricula/{cpf}) e por endereco, e websockets abertos no processo; None desliga.
+# O limite por endereco e alto porque uma escola inteira pode sair pelo mesmo NAT
+LIMITE_CPF = (1.0, 10)
+LIMITE_ENDERECO = (50.0, 500)
+LIMITE_WEBSOCKETS = 20000
+
+# intervalo minimo entre duas mensagens de /ws/vagas para o mesmo cliente
+VAGAS_BROADCAST_INTERVAL = 0.5
@@ -1,70 +1,233 @@
 from __future__ import annotations
 
-from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from fastapi import WebSocket
-import asyncio
-from typing import Callable
-
-from config import MATUTINO_FILE_PATH, VESPERTINO_FILE_PATH, TURNO_CHOOSE_TIME, TURMA_CHOOSE_TIME, matutino, vespertino
-from utils import file_read, file_write, path_from_cpf
-from model import Turno, Aluno, get_matutino_capacity, get_vespertino_capacity, get_turnos_capacity
-
-
-class AlunoStatus(Enum):
-    WAITING = 0
-    CHOOSING = 1
+import asyncio, math, sqlite3
+from collections import deque
+from typing import Awaitable, Callable
+
+from config import (TURNO_CHOOSE_TIME, TURMA_CHOOSE_TIME, COORDINATION_POLL_TIME, POSICAO_TICK_TIME,
+                    RECONNECT_GRACE_TIME, RECONNECT_BUFFER, OUTBOX_LIMIT, SLOW_CONSUMER_POLICY)
+from background import BackgroundTask
+from broadcast import VagasBroadcaster
+from coordination import SqliteCoordination
+from fila import Fila
+from metrics import RateMeter, send_seconds, sessions_expired, slow_consumers, timeouts
+from model import AlunoStatus, Vagas, vagas, turnos_capacity_fn, turno_capacity_fn
+from protocolo import Pedido, codificar, tipo
+from storage import FileStorage, SqliteStorage, storage
+from timers import DeadlineScheduler
+
+class BufferedSocket:
+    """Guarda as mensagens de um cliente desconectado para reenviar quando ele voltar"""
+    def __init__(self, dropped: WebSocket, maxlen: int = RECONNECT_BUFFER):
+        self.dropped = dropped
+        self.messages: deque[str] = deque(maxlen=maxlen)
+
+    async def send_text(self, data: str):
+        self.messages.append(data)
 
 @dataclass
 class ClientConnection:
+    """Conexao de um cpf; as mensagens saem por uma fila escrita por uma tarefa propria.
+
+    send() so enfileira, entao quem muda o estado das filas (check, remove,
+    matricula_turma) nunca espera a rede. A fila tem no maximo OUTBOX_LIMIT
+    mensagens; um cliente que nao acompanha segue SLOW_CONSUMER_POLICY.
+    """
     socket: WebSocket
     cpf: str
+    # com sessao no ConnectionManager um envio que falha fica guardado ate a reconexao
+    resumable: bool = False
+    # sem sessao para retomar, chamado quando o socket falha ou o cliente e desconectado por lentidao
+    on_failure: Callable[[ClientConnection], Awaitable[None]] | None = field(default=None, compare=False)
+    outbox: deque[str] = field(default_factory=deque, repr=False, compare=False)
+    writer: asyncio.Task | None = field(default=None, repr=False, compare=False)
+    # socket que o writer deve fechar porque o cliente ficou lento
+    slow: WebSocket | None = field(default=None, repr=False, compare=False)
+    protocolo: str = field(default="texto", compare=False)
+    # id do pedido em execucao, devolvido nas respostas a ele
+    pedido: int | str | None = field(default=None, compare=False)
+    # a matricula feita por esta conexao; evita reler o aluno a cada mensagem
+    matriculado: bool = field(default=False, compare=False)
 
     def __hash__(self):
         return hash(self.cpf)
 
-async def matricula_aluno(cpf: str, turma: str) -> bool:
-    turno_path = (
-        MATUTINO_FILE_PATH
-        if turma in matutino
-        else VESPERTINO_FILE_PATH
+    def buffer(self) -> BufferedSocket:
+        if not isinstance(self.socket, BufferedSocket):
+            self.socket = BufferedSocket(self.socket)
+        return self.socket
 
-    )
-    turno = Turno.from_string(await file_read(turno_path))
-    t_idx = -1
-    for idx, t in enumerate(turno.turmas):
-        if t.name == turma:
-            t_idx  = idx
+    def attach(self, socket: WebSocket):
+        """Troca o socket; o que ficou guardado na queda sai antes das mensagens ainda na fila"""
+        previous, self.socket = self.socket, socket
+        if isinstance(previous, BufferedSocket):
+            self.outbox.extendleft(reversed(previous.messages))
+        self.wake()
 
-    if turno.turmas[t_idx].verde == 0:
-        return False
+    def send(self, data: str):
+        """Evento que nao responde a um pedido (vez, remove, posicao periodica)"""
+        self.enqueue(codificar(self.protocolo, data))
 
-    turno.turmas[t_idx].verde -= 1
-    turno.turmas[t_idx].vermelho += 1
-    student = Aluno(turma=turma)
-    student_path = path_from_cpf(cpf)
-    await file_write(student_path, student.to_string())
-    await file_write(turno_path, turno.to_string())
-    return True
+    def reply(self, data: str):
+        """Resposta ao pedido em execucao"""
+        self.enqueue(codificar(self.protocolo, data, self.pedido))
+
+    def enqueue(self, data: str):
+        if len(self.outbox) >= OUTBOX_LIMIT and not self.overflow():
+            return
+        self.outbox.append(data)
+        self.wake()
+
+    def overflow(self) -> bool:
+        """Fila de saida cheia; devolve se a mensagem nova ainda deve entrar"""
+        if SLOW_CONSUMER_POLICY == "drop":
+            for idx, queued in enumerate(self.outbox):
+                if tipo(queued) == "posicao":
+                    del self.outbox[idx]
+                    slow_consumers.inc("drop")
+                    return True
+
+        if isinstance(self.socket, BufferedSocket):
+            # ja caiu: o proprio buffer descarta as mais antigas
+            return True
+        slow_consumers.inc("disconnect")
+        self.slow = self.socket
+        if self.resumable:
+            # o que estava na fila espera a reconexao
+            self.buffer().messages.extend(self.outbox)
+        self.outbox.clear()
+        # o writer pode estar parado no envio para o socket lento
+        if self.writer is not None:
+            self.writer.cancel()
+        self.writer = asyncio.get_running_loop().create_task(self.write())
+        return self.resumable
+
+    def wake(self):
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.get_running_loop().create_task(self.write())
+
+    async def write(self):
+        while True:
+            if self.slow is not None:
+                slow, self.slow = self.slow, None
+                try:
+                    await slow.close(code=1013)
+                except Exception:
+                    pass
+                if not self.resumable:
+                    await self.fail()
+                    return
+
+            if len(self.outbox) == 0:
+                return
+            data = self.outbox.popleft()
+            socket = self.socket
+            try:
+                with send_seconds.time():
+                    await socket.send_text(data)
+            except asyncio.CancelledError:
+                # desconectado por lentidao no meio do envio: a mensagem e a mais antiga do buffer
+                if self.resumable and isinstance(self.socket, BufferedSocket):
+                    self.socket.messages.appendleft(data)
+                raise
+            except Exception:
+                if not self.resumable:
+                    self.outbox.clear()
+                    await self.fail()
+                    return
+                # o socket caiu: a mensagem volta para a fila e vai para o buffer ou para o socket que o substituiu
+                if socket is self.socket:
+                    self.buffer()
+                self.outbox.appendleft(data)
+
+    async def fail(self):
+        if self.on_failure is not None:
+            await self.on_failure(self)
+
+    async def flush(self):
+        """Espera a fila de saida esvaziar"""
+        while self.writer is not None and not self.writer.done():
+            await asyncio.wait([self.writer])
+
+def mensagem_posicao(posicao: int, rate: float) -> str:
+    """eta em segundos pela taxa de admissao observada; "?" enquanto ninguem foi admitido"""
+    eta = "?" if rate == 0 else str(math.ceil(posicao / rate))
+    return f"posicao:{posicao} eta:{eta}"
 
 
 class TurnoManager:
-    def __init__(self, choose_time: int, get_capacity_fn: Callable[[], int], parent_turno: TurnoManager | None = None):
-        self.queue: asyncio.Queue[ClientConnection] = asyncio.Queue()
+    def __init__(self, name: str, choose_time: int, get_capacity_fn: Callable[[], int], parent_turno: TurnoManager | None = None, deadlines: DeadlineScheduler | None = None):
+        self.name = name
+        self.queue: Fila = Fila()
         self.status: dict[ClientConnection, AlunoStatus] = {}
-        self.stop_status: dict[ClientConnection, int] = {}
         self.choosing = 0
         self.choose_time = choose_time
         self.get_capacity = get_capacity_fn
         self.parent_turno = parent_turno
+        self.deadlines = deadlines if deadlines is not None else DeadlineScheduler()
+        self.admissions = RateMeter()
+        self.dispatcher = BackgroundTask(self.dispatch)
+        # ultima posicao enviada a cada cliente esperando
+        self.posicoes: dict[ClientConnection, int] = {}
+        self.tick_time = POSICAO_TICK_TIME
+        self.ticker = BackgroundTask(self.tick)
+
+    def notify(self):
+        """Acorda o dispatcher: a fila ou a capacidade mudaram"""
+        self.dispatcher.notify()
+
+    async def dispatch(self, wakeup: asyncio.Event):
+        while True:
+            await wakeup.wait()
+            wakeup.clear()
+            await self.check()
+
+    async def tick(self, wakeup: asyncio.Event):
+        """Enquanto houver clientes esperando, envia as posicoes que mudaram a cada tick_time"""
+        while True:
+            await wakeup.wait()
+            wakeup.clear()
+            while self.has_waiting():
+                await asyncio.sleep(self.tick_time)
+                await self.send_posicoes()
+
+    def has_waiting(self) -> bool:
+        return len(self.queue) > 0
+
+    def counts(self) -> tuple[int, int]:
+        """(esperando, escolhendo) para as metricas"""
+        return len(self.queue), self.choosing
+
+    async def position(self, client_connection: ClientConnection) -> int | None:
+        return self.queue.position(client_connection)
+
+    async def waiting_positions(self) -> list[tuple[ClientConnection, int]]:
+        return [(client, posicao) for posicao, client in enumerate(self.queue, start=1)]
+
+    async def send_posicoes(self):
+        """Uma passada pela fila inteira; so escreve para quem mudou de posicao"""
+        rate = self.admissions.rate()
+        for client, posicao in await self.waiting_positions():
+            if self.posicoes.get(client) == posicao:
+                continue
+            self.posicoes[client] = posicao
+            client.send(mensagem_posicao(posicao, rate))
 
     async def add(self, client_connection: ClientConnection):
         self.status[client_connection] = AlunoStatus.WAITING
-        self.queue.put_nowait(client_connection)
-        await client_connection.socket.send_text("ok")
-        asyncio.create_task(self.check())
+        self.queue.append(client_connection)
+        client_connection.reply("ok")
+        self.notify()
+        self.ticker.notify()
 
     async def remove(self, client_connection: ClientConnection):
+        self.deadlines.cancel((self, client_connection))
+        self.posicoes.pop(client_connection, None)
+        if client_connection in self.queue:
+            # sai da fila na hora: o check nunca admite quem ja foi embora
+            self.queue.take(client_connection)
         if client_connection in self.status:
             if self.status[client_connection] == AlunoStatus.CHOOSING:
                 self.choosing -= 1
@@ -73,128 +236,366 @@ class TurnoManager:
             if self.parent_turno is not None:
                 await self.parent_turno.remove(client_connection)
 
-            try:
-                await client_connection.socket.send_text("remove")
-            except Exception:
-                pass
+            client_connection.send("remove")
 
-        asyncio.create_task(self.check())
+        self.notify()
 
-    def is_choosing(self, client_connection: ClientConnection):
-        return (client_connection in self.status) and (self.status[client_connection] == AlunoStatus.CHOOSING)
+    async def contains(self, client_connection: ClientConnection):
+        return client_connection in self.status
 
-    def add_client_remove_status(self, client_connection: ClientConnection):
-        if client_connection in self.stop_status:
-            self.stop_status[client_connection] += 1
-        else:
-            self.stop_status[client_connection] = 1
+    async def is_choosing(self, client_connection: ClientConnection):
+        return (client_connection in self.status) and (self.status[client_connection] == AlunoStatus.CHOOSING)
 
-    async def remove_after_time(self, client_connection: ClientConnection, time: int):
-        await asyncio.sleep(time)
-        self.stop_status[client_connection] -= 1
-        if self.stop_status[client_connection] == 0:
-            self.stop_status.pop(client_connection)
-            await self.remove(client_connection)
+    def start_deadline(self, client_connection: ClientConnection, choose_time: float | None = None):
+        choose_time = self.choose_time if choose_time is None else choose_time
+        self.deadlines.schedule((self, client_connection), choose_time, lambda: self.expire(client_connection))
+
+    def suspend_deadline(self, client_connection: ClientConnection):
+        """O cliente passou para a fila de um turno filho, que controla o prazo dele daqui em diante"""
+        self.deadlines.cancel((self, client_connection))
+
+    async def expire(self, client_connection: ClientConnection):
+        timeouts.inc(self.name)
+        await self.remove(client_connection)
+
+    def snapshot(self) -> dict:
+        """Ordem da fila e o prazo que falta a quem esta escolhendo (None se suspenso por um turno filho)"""
+        escolhendo = {client.cpf: self.deadlines.remaining((self, client))
+                      for client, status in self.status.items() if status == AlunoStatus.CHOOSING}
+        return {"fila": [client.cpf for client in self.queue], "escolhendo": escolhendo}
+
+    def restore(self, estado: dict, clients: dict[str, ClientConnection]):
+        """Refaz a fila e os status de snapshot(); cpfs fora de clients sao ignorados"""
+        for cpf in estado["fila"]:
+            if cpf in clients:
+                self.status[clients[cpf]] = AlunoStatus.WAITING
+                self.queue.append(clients[cpf])
+        for cpf, remaining in estado["escolhendo"].items():
+            if cpf in clients:
+                self.status[clients[cpf]] = AlunoStatus.CHOOSING
+                self.choosing += 1
+                if remaining is not None:
+                    self.start_deadline(clients[cpf], remaining)
+        self.notify()
+        self.ticker.notify()
 
     async def check(self):
-        while(self.choosing < await self.get_capacity() and not self.queue.empty()):
+        """Admite de uma vez quantos clientes a capacidade permitir"""
+        free = await self.get_capacity() - self.choosing
+        admitted = []
+        while free > 0 and len(self.queue) > 0:
+            free -= 1
             self.choosing += 1
-            client = await self.queue.get()
+            client = self.queue.popleft()
+            self.posicoes.pop(client, None)
             self.status[client] = AlunoStatus.CHOOSING
+            self.start_deadline(client)
+            admitted.append(client)
+
+        if len(admitted) > 0:
+            self.admissions.mark(len(admitted))
+        for client in admitted:
+            client.send("vez")
+
+class SharedTurnoManager(TurnoManager):
+    """TurnoManager com a fila no backend de coordenacao, compartilhada entre workers"""
+    def __init__(self, name: str, coordination: SqliteCoordination, choose_time: int, get_capacity_fn: Callable[[], int], parent_turno: TurnoManager | None = None, deadlines: DeadlineScheduler | None = None, vagas: Vagas = vagas):
+        super().__init__(name, choose_time, get_capacity_fn, parent_turno, deadlines)
+        self.coordination = coordination
+        self.vagas = vagas
+        self.clients: dict[str, ClientConnection] = {}
+        self.poll_task: asyncio.Task | None = None
+
+    async def add(self, client_connection: ClientConnection):
+        self.clients[client_connection.cpf] = client_connection
+        await asyncio.to_thread(self.coordination.add, self.name, client_connection.cpf)
+        client_connection.reply("ok")
+        if self.poll_task is None or self.poll_task.done():
+            self.poll_task = asyncio.create_task(self.poll())
+        self.notify()
+        self.ticker.notify()
+
+    async def remove(self, client_connection: ClientConnection):
+        self.deadlines.cancel((self, client_connection))
+        self.posicoes.pop(client_connection, None)
+        if self.clients.get(client_connection.cpf) == client_connection:
+            self.clients.pop(client_connection.cpf)
+            if await asyncio.to_thread(self.coordination.remove, self.name, client_connection.cpf) is not None:
+                if self.parent_turno is not None:
+                    await self.parent_turno.remove(client_connection)
+
+                client_connection.send("remove")
+
+        self.notify()
+
+    async def contains(self, client_connection: ClientConnection):
+        return await asyncio.to_thread(self.coordination.status, self.name, client_connection.cpf) is not None
+
+    async def is_choosing(self, client_connection: ClientConnection):
+        return await asyncio.to_thread(self.coordination.status, self.name, client_connection.cpf) == AlunoStatus.CHOOSING
 
-            self.add_client_remove_status(client)
-            asyncio.create_task(self.remove_after_time(client, self.choose_time))
+    def has_waiting(self) -> bool:
+        return len(self.clients) > 0
 
-            await client.socket.send_text("vez")
+    def counts(self) -> tuple[int, int]:
+        """Somente os clientes deste worker; quem esta escolhendo tem um prazo correndo"""
+        choosing = sum(1 for client in self.clients.values() if (self, client) in self.deadlines.deadlines)
+        return len(self.clients) - choosing, choosing
+
+    async def position(self, client_connection: ClientConnection) -> int | None:
+        return await asyncio.to_thread(self.coordination.posicao, self.name, client_connection.cpf)
+
+    async def waiting_positions(self) -> list[tuple[ClientConnection, int]]:
+        try:
+            rows = await asyncio.to_thread(self.coordination.posicoes, self.name)
+        except sqlite3.OperationalError:
+            return []
+        return [(self.clients[cpf], posicao) for cpf, posicao in rows if cpf in self.clients]
+
+    async def poll(self):
+        """Avisa os clientes deste worker admitidos por qualquer worker; admit() tambem renova o heartbeat"""
+        while len(self.clients) > 0:
+            await asyncio.sleep(COORDINATION_POLL_TIME)
+            self.notify()
+
+    async def check(self):
+        try:
+            await asyncio.to_thread(self.vagas.refresh)
+            await asyncio.to_thread(self.coordination.admit, self.name, await self.get_capacity())
+            cpfs = await asyncio.to_thread(self.coordination.take_admitted, self.name)
+        except sqlite3.OperationalError:
+            # banco ocupado por outro worker: tenta de novo no proximo poll
+            return
+        admitted = []
+        for cpf in cpfs:
+            client = self.clients.get(cpf)
+            if client is None:
+                continue
+
+            self.posicoes.pop(client, None)
+            self.start_deadline(client)
+            admitted.append(client)
+
+        if len(admitted) > 0:
+            self.admissions.mark(len(admitted))
+        for client in admitted:
+            client.send("vez")
 
 class ConnectionManager:
-    def __init__(self):
-        self.turno = TurnoManager(TURNO_CHOOSE_TIME, get_turnos_capacity)
-        self.matutino = TurnoManager(TURMA_CHOOSE_TIME, get_matutino_capacity, self.turno)
-        self.vespertino = TurnoManager(TURMA_CHOOSE_TIME, get_vespertino_capacity, self.turno)
+    """Fila de escolha do turno e, abaixo dela, uma fila de escolha de turma por turno.
+
+    Os turnos sao os configurados no armazenamento; cada curso tem o seu
+    ConnectionManager, com as suas vagas e o seu armazenamento.
+    """
+    def __init__(self, coordination: SqliteCoordination | None = None, vagas: Vagas = vagas, storage: FileStorage | SqliteStorage = storage):
+        self.coordination = coordination
+        self.vagas = vagas
+        self.storage = storage
+        self.deadlines = DeadlineScheduler()
+        self.turno = self.new_turno_manager("turno", TURNO_CHOOSE_TIME, turnos_capacity_fn(vagas))
+        self.turnos: dict[str, TurnoManager] = {
+            nome: self.new_turno_manager(nome, TURMA_CHOOSE_TIME, turno_capacity_fn(nome, vagas), self.turno)
+            for nome in storage.turnos
+        }
+        self.vagas_broadcaster = VagasBroadcaster(vagas)
+        # uma conexao por cpf; reconectar retoma a mesma, com lugar e status nas filas
+        self.sessions: dict[str, ClientConnection] = {}
+        self.grace_time = RECONNECT_GRACE_TIME
+
+    def all_turnos(self) -> list[TurnoManager]:
+        return [self.turno, *self.turnos.values()]
+
+    def notify_all(self):
+        for turno in self.all_turnos():
+            turno.notify()
+        self.vagas_broadcaster.notify()
+
+    def start(self):
+        """Prende dispatchers, prazos e o envio de vagas ao event loop do app"""
+        self.deadlines.runner.start()
+        self.vagas_broadcaster.runner.start()
+        for turno in self.all_turnos():
+            turno.dispatcher.start()
+            turno.ticker.start()
+
+    def stop(self):
+        self.deadlines.runner.stop()
+        self.vagas_broadcaster.runner.stop()
+        for turno in self.all_turnos():
+            turno.dispatcher.stop()
+            turno.ticker.stop()
+
+    def new_turno_manager(self, name: str, choose_time: int, get_capacity_fn: Callable[[], int], parent_turno: TurnoManager | None = None) -> TurnoManager:
+        if self.coordination is None:
+            return TurnoManager(name, choose_time, get_capacity_fn, parent_turno, self.deadlines)
+        return SharedTurnoManager(name, self.coordination, choose_time, get_capacity_fn, parent_turno, self.deadlines, self.vagas)
+
+    async def connect(self, socket: WebSocket, cpf: str, protocolo: str = "texto") -> ClientConnection:
+        """Aceita o socket; se o cpf ja tem uma sessao, o novo socket assume a mesma conexao.
+
+        O cliente pode reconectar antes de o servidor perceber que o socket
+        antigo caiu, entao uma sessao ainda ativa tambem e assumida.
+        """
+        await socket.accept()
+        client_connection = self.sessions.get(cpf)
+        if client_connection is None:
+            client_connection = ClientConnection(socket=socket, cpf=cpf, resumable=True, protocolo=protocolo)
+            self.sessions[cpf] = client_connection
+            return client_connection
+
+        self.deadlines.cancel(("reconexao", cpf))
+        # a conexao continua a mesma nas filas: status e prazo de escolha nao mudam
+        client_connection.attach(socket)
+        client_connection.protocolo = protocolo
+
+        # um "vez" escrito no socket antigo pouco antes da queda pode nao ter chegado
+        turno = await self.current_turno(client_connection)
+        vez_na_fila = any(tipo(queued) == "vez" for queued in client_connection.outbox)
+        if turno is not None and not vez_na_fila and await turno.is_choosing(client_connection):
+            client_connection.send("vez")
+        return client_connection
+
+    async def current_turno(self, client_connection: ClientConnection) -> TurnoManager | None:
+        """A fila mais adiante em que o cliente esta"""
+        for turno in [*self.turnos.values(), self.turno]:
+            if await turno.contains(client_connection):
+                return turno
+        return None
+
+    async def detach(self, client_connection: ClientConnection, socket: WebSocket):
+        """O socket caiu: segura o lugar nas filas por grace_time antes de desconectar"""
+        current = client_connection.socket
+        if current is not socket and not (isinstance(current, BufferedSocket) and current.dropped is socket):
+            # outro socket do mesmo cpf ja assumiu a conexao
+            return
+
+        if await self.current_turno(client_connection) is None:
+            if self.sessions.get(client_connection.cpf) is client_connection:
+                self.sessions.pop(client_connection.cpf)
+            return
 
-    async def connect(self, client_connection: ClientConnection):
-        await client_connection.socket.accept()
+        client_connection.buffer()
+        self.deadlines.schedule(("reconexao", client_connection.cpf), self.grace_time,
+                                lambda: self.expire_session(client_connection))
+
+    async def expire_session(self, client_connection: ClientConnection):
+        if self.sessions.get(client_connection.cpf) is client_connection and isinstance(client_connection.socket, BufferedSocket):
+            self.sessions.pop(client_connection.cpf)
+            sessions_expired.inc()
+            await self.disconnect(client_connection)
+
+    def snapshot(self) -> dict | None:
+        """Filas, status e prazos para retomar depois de reiniciar; com coordenacao eles ja ficam no banco"""
+        if self.coordination is not None:
+            return None
+        return {"versao": 1, "turnos": {turno.name: turno.snapshot() for turno in self.all_turnos()}}
+
+    async def restore(self, estado: dict):
+        """Volta ao estado de snapshot() antes de aceitar conexoes.
+
+        Cada cpf ganha uma sessao sem socket, como se tivesse acabado de cair:
+        tem grace_time para reconectar. O prazo de escolha continua de onde
+        parou, sem contar o tempo desligado.
+        """
+        cpfs = {cpf for turno in estado["turnos"].values() for cpf in [*turno["fila"], *turno["escolhendo"]]}
+        clients: dict[str, ClientConnection] = {}
+        for cpf in cpfs:
+            student = await self.storage.aluno(cpf)
+            if student is None or student.turma != "X":
+                continue
+            client_connection = ClientConnection(socket=BufferedSocket(None), cpf=cpf, resumable=True)
+            clients[cpf] = client_connection
+            self.sessions[cpf] = client_connection
+            self.deadlines.schedule(("reconexao", cpf), self.grace_time,
+                                    lambda client_connection=client_connection: self.expire_session(client_connection))
+
+        for turno in self.all_turnos():
+            if turno.name in estado["turnos"]:
+                turno.restore(estado["turnos"][turno.name], clients)
 
     async def disconnect(self, client_connection: ClientConnection):
-        await self.turno.remove(client_connection)
-        await self.matutino.remove(client_connection)
-        await self.vespertino.remove(client_connection)
+        for turno in self.all_turnos():
+            await turno.remove(client_connection)
+
+    async def in_any_turno(self, client_connection: ClientConnection) -> bool:
+        for turno in self.turnos.values():
+            if await turno.contains(client_connection):
+                return True
+        return False
 
     async def matricula_turno(self, client_connection: ClientConnection):
-        if client_connection in self.turno.status:
-            await client_connection.socket.send_text("error: cpf ja esta na fila de turnos")
+        if client_connection.on_failure is None:
+            # sem sessao para retomar, um socket que falha sai das filas
+            client_connection.on_failure = self.disconnect
+        if await self.turno.contains(client_connection):
+            client_connection.reply("error: cpf ja esta na fila de turnos")
             return
-        elif client_connection in self.matutino.status or client_connection in self.vespertino.status:
-            await client_connection.socket.send_text("error: cpf ja esta na fila outro turno")
+        elif await self.in_any_turno(client_connection):
+            client_connection.reply("error: cpf ja esta na fila outro turno")
             return
 
         await self.turno.add(client_connection)
 
-    async def matricula_matutino(self, client_connection: ClientConnection):
-        if await get_matutino_capacity() == 0:
-            await client_connection.socket.send_text("error: turno cheio")
+    async def matricula_no_turno(self, client_connection: ClientConnection, nome: str):
+        """Quem tem a vez na fila de turnos entra na fila de escolha de turma do turno nome"""
+        if await self.turnos[nome].get_capacity() == 0:
+            client_connection.reply("error: turno cheio")
             return
 
-        if not self.turno.is_choosing(client_connection):
-            await client_connection.socket.send_text("error: nao esta na sua vez")
+        if not await self.turno.is_choosing(client_connection):
+            client_connection.reply("error: nao esta na sua vez")
             return
 
-        if client_connection in self.matutino.status or client_connection in self.vespertino.status:
-            await client_connection.socket.send_text("error: cpf ja esta na fila de outro turno")
+        if await self.in_any_turno(client_connection):
+            client_connection.reply("error: cpf ja esta na fila de outro turno")
             return
 
-        self.turno.add_client_remove_status(client_connection)
-        await self.matutino.add(client_connection)
+        self.turno.suspend_deadline(client_connection)
+        await self.turnos[nome].add(client_connection)
 
-    async def matricula_vespertino(self, client_connection: ClientConnection):
-        if await get_vespertino_capacity() == 0:
-            await client_connection.socket.send_text("error: turno cheio")
+    async def matricula_turma(self, client_connection: ClientConnection, turma: str):
+        nome = self.vagas.turno_da_turma.get(turma)
+        if nome is None or nome not in self.turnos:
+            client_connection.reply("error: turma invalida")
             return
 
-        if (not client_connection in self.turno.status) or (self.turno.status[client_connection] != AlunoStatus.CHOOSING):
-            await client_connection.socket.send_text("error: nao esta na sua vez")
+        if not await self.turnos[nome].is_choosing(client_connection):
+            client_connection.reply("error: nao esta na sua vez")
             return
 
-        if client_connection in self.matutino.status or client_connection in self.vespertino.status:
-            await client_connection.socket.send_text("error: cpf ja esta na fila de outro turno")
+        if not await self.storage.matricula(client_connection.cpf, turma):
+            client_connection.reply("error: turma cheia")
             return
 
-        self.turno.add_client_remove_status(client_connection)
-        await self.vespertino.add(client_connection)
-
-    async def matricula_turma(self, client_connection: ClientConnection, turma: str):
-        if turma in matutino:
-            if not self.matutino.is_choosing(client_connection):
-                await client_connection.socket.send_text("error: nao esta na sua vez")
-                return
+        client_connection.matriculado = True
+        client_connection.reply("ok")
+        await self.disconnect(client_connection)
 
-            if not await matricula_aluno(client_connection.cpf, turma):
-                await client_connection.socket.send_text("error: turma cheia")
+    async def posicao(self, client_connection: ClientConnection):
+        for turno in [*self.turnos.values(), self.turno]:
+            posicao = await turno.position(client_connection)
+            if posicao is not None:
+                client_connection.reply(mensagem_posicao(posicao, turno.admissions.rate()))
                 return
 
-            await client_connection.socket.send_text("ok")
-            await self.turno.remove(client_connection)
-            await self.matutino.remove(client_connection)
-            await self.vespertino.remove(client_connection)
-
-        elif turma in vespertino:
-            if not self.vespertino.is_choosing(client_connection):
-                await client_connection.socket.send_text("error: nao esta na sua vez")
-                return
-
-            if not await matricula_aluno(client_connection.cpf, turma):
-                await client_connection.socket.send_text("error: turma cheia")
-                return
-                                
-            await client_connection.socket.send_text("ok")
-            await self.turno.remove(client_connection)
-            await self.matutino.remove(client_connection)
-            await self.vespertino.remove(client_connection)
-
-        else:
-            await client_connection.socket.send_text("error: turma invalida")
-            return
+        client_connection.reply("error: cpf nao esta esperando em nenhuma fila")
+
+    async def comando(self, client_connection: ClientConnection, pedido: Pedido):
+        """Executa um pedido; as respostas levam o id dele"""
+        client_connection.pedido = pedido.id
+        try:
+            if pedido.comando == "turno":
+                await self.matricula_turno(client_connection)
+            elif pedido.comando in self.turnos:
+                await self.matricula_no_turno(client_connection, pedido.comando)
+            elif pedido.comando == "posicao":
+                await self.posicao(client_connection)
+            elif pedido.comando == "turma":
+                await self.matricula_turma(client_connection, pedido.argumento)
+            else:
+                await self.command_not_found(client_connection, pedido.comando)
+        finally:
+            client_connection.pedido = None
 
     async def command_not_found(self, client_connection: ClientConnection, command: str):
-        await client_connection.socket.send_text(f"error: command not found {command}")
+        client_connection.reply(f"error: command not found {command}")
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import sqlite3, threading, time, uuid
+from contextlib import contextmanager
+
+from config import COORDINATION, COORDINATION_DB_PATH, COORDINATION_BUSY_TIMEOUT, COORDINATION_WORKER_TIMEOUT, STORAGE
+from metrics import io_seconds
+from model import AlunoStatus
+
+WORKER_ID = uuid.uuid4().hex
+
+
+class SqliteCoordination:
+    """Filas e status compartilhados entre processos em um banco SQLite em modo WAL.
+
+    Os sockets continuam no worker que os aceitou; o banco so decide a ordem
+    global da fila e quem esta escolhendo. Cada worker avisa os seus clientes.
+    Os metodos bloqueiam e devem rodar fora do event loop (asyncio.to_thread).
+    """
+    def __init__(self, path: str, worker: str = WORKER_ID):
+        self.worker = worker
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=COORDINATION_BUSY_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS fila (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                turno TEXT NOT NULL,
+                cpf TEXT NOT NULL,
+                worker TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                notified INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (turno, cpf)
+            );
+            CREATE INDEX IF NOT EXISTS fila_status ON fila (turno, status, seq);
+            CREATE TABLE IF NOT EXISTS worker (
+                id TEXT PRIMARY KEY,
+                seen REAL NOT NULL
+            );
+        """)
+        self.heartbeat()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock, io_seconds.time("coordenacao"):
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def heartbeat(self):
+        with self.transaction() as db:
+            self.touch(db)
+
+    def touch(self, db: sqlite3.Connection):
+        db.execute("INSERT OR REPLACE INTO worker (id, seen) VALUES (?, ?)", (self.worker, time.time()))
+
+    def add(self, turno: str, cpf: str):
+        with self.transaction() as db:
+            # um worker parado ha muito tempo seria tomado como morto e perderia esta linha
+            self.touch(db)
+            db.execute("DELETE FROM fila WHERE turno = ? AND cpf = ?", (turno, cpf))
+            db.execute("INSERT INTO fila (turno, cpf, worker, status) VALUES (?, ?, ?, ?)",
+                       (turno, cpf, self.worker, AlunoStatus.WAITING.value))
+
+    def remove(self, turno: str, cpf: str) -> AlunoStatus | None:
+        with self.transaction() as db:
+            row = db.execute("SELECT status FROM fila WHERE turno = ? AND cpf = ? AND worker = ?",
+                             (turno, cpf, self.worker)).fetchone()
+            if row is None:
+                return None
+            db.execute("DELETE FROM fila WHERE turno = ? AND cpf = ?", (turno, cpf))
+            return AlunoStatus(row[0])
+
+    def status(self, turno: str, cpf: str) -> AlunoStatus | None:
+        with self.lock:
+            row = self.db.execute("SELECT status FROM fila WHERE turno = ? AND cpf = ?", (turno, cpf)).fetchone()
+        return None if row is None else AlunoStatus(row[0])
+
+    def admit(self, turno: str, capacity: int):
+        """Passa os primeiros da fila global para choosing enquanto houver capacidade"""
+        with self.transaction() as db:
+            self.touch(db)
+            # clientes de workers que morreram nao podem segurar vagas
+            db.execute("""DELETE FROM fila WHERE worker IN
+                          (SELECT id FROM worker WHERE seen < ?)""", (time.time() - COORDINATION_WORKER_TIMEOUT,))
+            [count] = db.execute("SELECT COUNT(*) FROM fila WHERE turno = ? AND status = ?",
+                                 (turno, AlunoStatus.CHOOSING.value)).fetchone()
+            if count >= capacity:
+                return
+            db.execute("""UPDATE fila SET status = ? WHERE seq IN
+                          (SELECT seq FROM fila WHERE turno = ? AND status = ? ORDER BY seq LIMIT ?)""",
+                       (AlunoStatus.CHOOSING.value, turno, AlunoStatus.WAITING.value, capacity - count))
+
+    def take_admitted(self, turno: str) -> list[str]:
+        """CPFs deste worker que entraram em choosing e ainda nao foram avisados"""
+        with self.transaction() as db:
+            rows = db.execute("""UPDATE fila SET notified = 1
+                                 WHERE turno = ? AND worker = ? AND status = ? AND notified = 0
+                                 RETURNING cpf, seq""", (turno, self.worker, AlunoStatus.CHOOSING.value)).fetchall()
+        return [cpf for cpf, _ in sorted(rows, key=lambda row: row[1])]
+
+    def posicao(self, turno: str, cpf: str) -> int | None:
+        """Posicao do cpf entre os que esperam no turno, em todos os workers"""
+        with self.lock:
+            row = self.db.execute("""SELECT COUNT(*) FROM fila WHERE turno = ? AND status = ? AND seq <=
+                                     (SELECT seq FROM fila WHERE turno = ? AND cpf = ? AND status = ?)""",
+                                  (turno, AlunoStatus.WAITING.value, turno, cpf, AlunoStatus.WAITING.value)).fetchone()
+        return None if row[0] == 0 else row[0]
+
+    def posicoes(self, turno: str) -> list[tuple[str, int]]:
+        """(cpf, posicao) dos clientes deste worker que esperam no turno, numa unica leitura"""
+        with self.lock:
+            rows = self.db.execute("""SELECT cpf, worker, ROW_NUMBER() OVER (ORDER BY seq) FROM fila
+                                      WHERE turno = ? AND status = ?""", (turno, AlunoStatus.WAITING.value)).fetchall()
+        return [(cpf, posicao) for cpf, worker, posicao in rows if worker == self.worker]
+
+
+def new_coordination(path: str = COORDINATION_DB_PATH) -> SqliteCoordination | None:
+    if COORDINATION == "sqlite":
+        if STORAGE != "sqlite":
+            # alunos em arquivos ficam na memoria de cada processo: um worker nao veria os cadastros do outro
+            raise RuntimeError("COORDINATION=sqlite exige STORAGE=sqlite")
+        return SqliteCoordination(path)
+    return None
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import asyncio, json, os, time
+from dataclasses import dataclass, field
+
+from background import BackgroundTask
+from config import CURSOS_DIR, CURSO_IDLE_TIME, SEP, load_turnos
+from connection import ConnectionManager
+from coordination import SqliteCoordination, new_coordination
+from model import Vagas
+from storage import FileStorage, SqliteStorage, new_storage
+from utils import file_write_atomic
+
+
+@dataclass(eq=False)
+class Curso:
+    nome: str
+    vagas: Vagas
+    storage: FileStorage | SqliteStorage
+    manager: ConnectionManager
+    ordem_turmas: list[str]
+    coordination: SqliteCoordination | None = None
+    # filas e prazos gravados ao desligar e retomados ao iniciar
+    estado_path: str | None = None
+    # requisicoes e websockets usando o curso agora
+    in_use: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+
+    def idle(self, now: float, idle_time: float) -> bool:
+        return (self.in_use == 0 and len(self.manager.sessions) == 0
+                and len(self.manager.vagas_broadcaster.subscribers) == 0
+                and now - self.last_used >= idle_time)
+
+    async def save_state(self):
+        """Grava as filas se ha alguem nelas; chamado ao desligar, antes de parar o manager"""
+        estado = self.manager.snapshot()
+        if self.estado_path is None or estado is None or len(self.manager.sessions) == 0:
+            return
+        await asyncio.to_thread(file_write_atomic, self.estado_path, json.dumps(estado, separators=(",", ":")))
+
+    async def restore_state(self):
+        """Retoma as filas gravadas; o arquivo e apagado para nao ser retomado de novo depois de uma queda"""
+        if self.estado_path is None or not os.path.exists(self.estado_path):
+            return
+        def read():
+            with open(self.estado_path, "r") as f:
+                estado = json.load(f)
+            os.remove(self.estado_path)
+            return estado
+        await self.manager.restore(await asyncio.to_thread(read))
+
+
+def new_curso(nome: str, vagas: Vagas, storage: FileStorage | SqliteStorage, ordem_turmas: list[str], coordination_path: str, estado_path: str | None = None) -> Curso:
+    """Liga as vagas ja carregadas pelo armazenamento a um ConnectionManager"""
+    coordination = new_coordination(coordination_path)
+    if coordination is not None:
+        # o banco SQLite do armazenamento ja e compartilhado e guarda as vagas e o contador
+        vagas.share(storage)
+    manager = ConnectionManager(coordination, vagas, storage)
+    vagas.listeners.append(manager.notify_all)
+    return Curso(nome=nome, vagas=vagas, storage=storage, manager=manager, ordem_turmas=ordem_turmas,
+                 coordination=coordination, estado_path=estado_path)
+
+
+def nome_valido(nome: str) -> bool:
+    return len(nome) > 0 and all(c.isalnum() or c in "-_" for c in nome)
+
+
+class Cursos:
+    """Cursos com um diretorio em CURSOS_DIR, carregados no primeiro acesso.
+
+    Um curso sem requisicoes, sessoes nem assinantes de /ws/vagas ha
+    idle_time segundos e descarregado: o journal vai para o disco e as
+    tarefas do manager param. O proximo acesso carrega de novo.
+    """
+    def __init__(self, path: str = CURSOS_DIR, idle_time: float = CURSO_IDLE_TIME):
+        self.path = path
+        self.idle_time = idle_time
+        self.cursos: dict[str, Curso] = {}
+        self.loading: dict[str, asyncio.Task] = {}
+        self.runner = BackgroundTask(self.run)
+
+    def load(self, nome: str) -> Curso:
+        """Le a configuracao e os dados do curso; bloqueia"""
+        data_dir = self.path + nome + SEP
+        config = data_dir + "turnos.json"
+        turnos, ordem_turmas = load_turnos(config if os.path.exists(config) else None)
+        vagas = Vagas()
+        storage = new_storage(data_dir, turnos, vagas)
+        storage.load()
+        return new_curso(nome, vagas, storage, ordem_turmas, data_dir + "coordination.sqlite", data_dir + "estado")
+
+    async def open(self, nome: str) -> Curso:
+        """Carrega, retoma as filas gravadas e so entao serve o curso"""
+        curso = await asyncio.to_thread(self.load, nome)
+        curso.manager.start()
+        await curso.restore_state()
+        self.cursos[nome] = curso
+        self.runner.notify()
+        return curso
+
+    async def get(self, nome: str) -> Curso | None:
+        curso = self.cursos.get(nome)
+        if curso is None:
+            if not nome_valido(nome) or not os.path.isdir(self.path + nome):
+                return None
+            # quem chega durante o carregamento espera o mesmo carregamento
+            task = self.loading.get(nome)
+            if task is None:
+                task = asyncio.create_task(self.open(nome))
+                self.loading[nome] = task
+            try:
+                curso = await asyncio.shield(task)
+            finally:
+                if self.loading.get(nome) is task:
+                    self.loading.pop(nome)
+
+        curso.last_used = time.monotonic()
+        return curso
+
+    async def run(self, wakeup: asyncio.Event):
+        while True:
+            await wakeup.wait()
+            wakeup.clear()
+            while len(self.cursos) > 0:
+                await asyncio.sleep(self.idle_time / 2)
+                await self.evict_idle()
+
+    async def evict_idle(self):
+        now = time.monotonic()
+        for nome, curso in list(self.cursos.items()):
+            if curso.idle(now, self.idle_time):
+                await self.evict(nome)
+
+    async def evict(self, nome: str):
+        curso = self.cursos.pop(nome)
+        await curso.save_state()
+        curso.manager.stop()
+        await asyncio.to_thread(curso.storage.close)
+
+    def start(self):
+        self.runner.start()
+
+    async def stop(self):
+        self.runner.stop()
+        for nome in list(self.cursos):
+            await self.evict(nome)
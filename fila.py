@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+from typing import Hashable, Iterator
+
+
+class Fila:
+    """Fila FIFO que informa a posicao de qualquer elemento em O(log n).
+
+    Cada elemento recebe um indice crescente; uma arvore de Fenwick sobre os
+    indices conta quantos ainda estao na fila ate cada ponto. Quando metade
+    dos indices ja saiu da fila eles sao renumerados.
+    """
+    def __init__(self):
+        self.items: list[Hashable | None] = []
+        self.tree: list[int] = [0]
+        self.index: dict[Hashable, int] = {}
+        self.head = 0
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, item: Hashable) -> bool:
+        return item in self.index
+
+    def __iter__(self) -> Iterator[Hashable]:
+        for idx in range(self.head, len(self.items)):
+            item = self.items[idx]
+            if item is not None:
+                yield item
+
+    def prefix(self, i: int) -> int:
+        """Quantos elementos estao na fila entre os indices 1 e i da arvore"""
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def update(self, i: int, delta: int):
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def append(self, item: Hashable):
+        self.items.append(item)
+        i = len(self.items)
+        self.index[item] = i
+        # o no i cobre (i - lowbit(i), i]: soma o proprio elemento aos anteriores no intervalo
+        self.tree.append(1 + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+
+    def popleft(self) -> Hashable:
+        while self.items[self.head] is None:
+            self.head += 1
+        item = self.items[self.head]
+        self.take(item)
+        return item
+
+    def take(self, item: Hashable):
+        i = self.index.pop(item)
+        self.items[i - 1] = None
+        self.update(i, -1)
+        if self.head > 1024 and self.head > len(self.items) // 2:
+            self.rebuild()
+
+    def position(self, item: Hashable) -> int | None:
+        """Posicao a partir de 1, ou None se nao esta na fila"""
+        i = self.index.get(item)
+        if i is None:
+            return None
+        return self.prefix(i)
+
+    def rebuild(self):
+        items = list(self)
+        self.items = []
+        self.tree = [0]
+        self.index = {}
+        self.head = 0
+        for item in items:
+            self.append(item)
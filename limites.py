@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import json, math, time
+from typing import Hashable
+
+from config import LIMITE_CPF, LIMITE_ENDERECO, LIMITE_WEBSOCKETS
+from metrics import rejected
+
+
+class TokenBucket:
+    """Um balde de fichas por chave: enche rate fichas por segundo ate burst e cada tentativa gasta uma.
+
+    Guarda no maximo max_keys chaves; a usada ha mais tempo e esquecida
+    primeiro e volta com o balde cheio.
+    """
+    def __init__(self, rate: float, burst: float, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # chave -> (fichas, quando foram contadas), em ordem de uso
+        self.buckets: dict[Hashable, tuple[float, float]] = {}
+
+    def now(self) -> float:
+        return time.monotonic()
+
+    def take(self, key: Hashable) -> float:
+        """Gasta uma ficha; devolve 0 ou quantos segundos faltam para a proxima"""
+        now = self.now()
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            del self.buckets[next(iter(self.buckets))]
+        return wait
+
+
+def cpf_do_caminho(path: str) -> str | None:
+    """O cpf de /api/cadastro/{cpf} e /ws/matricula/{cpf}, com ou sem o prefixo do curso"""
+    parts = path.rstrip("/").split("/")
+    if len(parts) >= 4 and (parts[-3], parts[-2]) in [("api", "cadastro"), ("ws", "matricula")]:
+        return parts[-1]
+    return None
+
+
+class Limites:
+    """Limites aplicados a cada requisicao e websocket antes do app, sem tocar no armazenamento"""
+    def __init__(self, cpf: tuple[float, float] | None = LIMITE_CPF, endereco: tuple[float, float] | None = LIMITE_ENDERECO,
+                 max_websockets: int | None = LIMITE_WEBSOCKETS):
+        self.cpf = None if cpf is None else TokenBucket(*cpf)
+        self.endereco = None if endereco is None else TokenBucket(*endereco)
+        self.max_websockets = max_websockets
+        self.websockets = 0
+
+    def check(self, scope) -> tuple[str, float] | None:
+        """(motivo, segundos ate tentar de novo) se a conexao deve ser recusada"""
+        if scope["type"] == "websocket" and self.max_websockets is not None and self.websockets >= self.max_websockets:
+            return "websockets", 1.0
+        if self.endereco is not None and scope.get("client") is not None:
+            wait = self.endereco.take(scope["client"][0])
+            if wait > 0:
+                return "endereco", wait
+        cpf = cpf_do_caminho(scope["path"])
+        if self.cpf is not None and cpf is not None:
+            wait = self.cpf.take(cpf)
+            if wait > 0:
+                return "cpf", wait
+        return None
+
+
+class LimitesMiddleware:
+    """Recusa com 429 (HTTP) ou fechando antes de aceitar (websocket, codigo 1013) quem passou dos limites"""
+    def __init__(self, app, limites: Limites):
+        self.app = app
+        self.limites = limites
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ["http", "websocket"]:
+            await self.app(scope, receive, send)
+            return
+
+        recusa = self.limites.check(scope)
+        if recusa is not None:
+            motivo, wait = recusa
+            rejected.inc(motivo)
+            if scope["type"] == "websocket":
+                await send({"type": "websocket.close", "code": 1013, "reason": "Muitas tentativas"})
+                return
+            await send({"type": "http.response.start", "status": 429, "headers": [
+                (b"content-type", b"application/json"), (b"retry-after", str(math.ceil(wait)).encode()),
+            ]})
+            await send({"type": "http.response.body", "body": json.dumps({"detail": "Muitas tentativas"}).encode()})
+            return
+
+        if scope["type"] == "http":
+            await self.app(scope, receive, send)
+            return
+        self.limites.websockets += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limites.websockets -= 1
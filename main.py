@@ -1,40 +1,65 @@
-from fastapi import FastAPI, HTTPException, WebSocketException, WebSocket, status, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+import time
+# duracao de cada fase da inicializacao, exposta em /metrics
+inicio = time.perf_counter()
+startup_seconds: dict[str, float] = {}
+
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, WebSocketException, WebSocket, Request, status, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from dataclasses import dataclass
-import asyncio, os 
+from contextlib import asynccontextmanager
+from starlette.requests import HTTPConnection
+from typing import AsyncIterator
+import asyncio, codecs, os 
 
 from connection import ConnectionManager, ClientConnection 
-from config import DATA_DIR, ALUNO_DIR, MATUTINO_FILE_PATH, VESPERTINO_FILE_PATH, ordem_turmas, matutino, vespertino
-from model import Aluno, Turno
-from utils import file_read, file_write, file_count_files_in_dir, path_from_cpf, file_exist
-
+from config import DATA_DIR, COORDINATION_DB_PATH, ESTADO_FILE_PATH, ordem_turmas
+from cursos import Curso, Cursos, new_curso
+from limites import Limites, LimitesMiddleware
+from metrics import command_seconds, registry
+from protocolo import PROTOCOLOS, ler
+from relatorio import FORMATOS, relatorio, turmas_do_relatorio
+from model import vagas
+from storage import storage
+from utils import cpf_valido, cpfs_from_json
 
-def start_db():
-    if not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR)
 
-    if not os.path.exists(ALUNO_DIR):
-        os.makedirs(ALUNO_DIR)
+startup_seconds["imports"] = time.perf_counter() - inicio
 
-    if not os.path.exists(MATUTINO_FILE_PATH):
-        content = "\n".join([f"{t} 0 0" for t in matutino])
-        with open(MATUTINO_FILE_PATH, "w") as f:
-            f.write(content)
 
-    if not os.path.exists(VESPERTINO_FILE_PATH):
-        content = "\n".join([f"{t} 0 0" for t in vespertino])
-        with open(VESPERTINO_FILE_PATH, "w") as f:
-            f.write(content)
+def start_db():
+    storage.load()
 
+inicio = time.perf_counter()
 start_db()
-
-app = FastAPI()
+startup_seconds["armazenamento"] = time.perf_counter() - inicio
+
+# o curso de DATA_DIR, servido nas rotas sem prefixo; os outros ficam em /{curso}/...
+padrao = new_curso("", vagas, storage, ordem_turmas, COORDINATION_DB_PATH, ESTADO_FILE_PATH)
+manager = padrao.manager
+cursos = Cursos()
+limites = Limites()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    manager.start()
+    inicio = time.perf_counter()
+    await padrao.restore_state()
+    startup_seconds["restauracao"] = time.perf_counter() - inicio
+    cursos.start()
+    yield
+    await padrao.save_state()
+    manager.stop()
+    await cursos.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "*",
 ]
 
+# por dentro do CORS: as respostas 429 tambem levam os cabecalhos
+app.add_middleware(LimitesMiddleware, limites=limites)
+
 app.add_middleware (
     CORSMiddleware,
     allow_origins=origins,
@@ -43,7 +68,56 @@ app.add_middleware (
     allow_headers=["*"],
 )
 
-manager = ConnectionManager()
+def todos_cursos() -> list[Curso]:
+    return [padrao, *cursos.cursos.values()]
+
+def turnos_metricas():
+    return [(curso.nome, turno) for curso in todos_cursos() for turno in curso.manager.all_turnos()]
+
+registry.collector("matricula_fila_esperando", "Clientes esperando a vez", "gauge", ("curso", "turno"),
+                   lambda: [((curso, turno.name), turno.counts()[0]) for curso, turno in turnos_metricas()])
+registry.collector("matricula_fila_escolhendo", "Clientes com a vez, escolhendo", "gauge", ("curso", "turno"),
+                   lambda: [((curso, turno.name), turno.counts()[1]) for curso, turno in turnos_metricas()])
+registry.collector("matricula_admissoes_total", "Clientes admitidos (receberam a vez)", "counter", ("curso", "turno"),
+                   lambda: [((curso, turno.name), turno.admissions.total) for curso, turno in turnos_metricas()])
+registry.collector("matricula_sessoes", "Conexoes de matricula abertas ou esperando reconexao", "gauge", ("curso",),
+                   lambda: [((curso.nome,), len(curso.manager.sessions)) for curso in todos_cursos()])
+registry.collector("matricula_vagas", "Vagas livres (verde) e ocupadas (vermelho) de cada turma", "gauge", ("curso", "turma", "estado"),
+                   lambda: [((curso.nome, t.name, estado), getattr(t, estado)) for curso in todos_cursos()
+                            for turno in curso.vagas.turnos.values() for t in turno.turmas for estado in ["verde", "vermelho"]])
+registry.collector("matricula_inicio_seconds", "Duracao das fases da inicializacao", "gauge", ("fase",),
+                   lambda: [((fase,), segundos) for fase, segundos in startup_seconds.items()])
+registry.collector("matricula_websockets_abertos", "Websockets abertos neste processo", "gauge", (),
+                   lambda: [((), limites.websockets)])
+registry.collector("matricula_cursos_carregados", "Cursos em memoria alem do padrao", "gauge", (),
+                   lambda: [((), len(cursos.cursos))])
+
+def nome_comando(comando: str, curso: Curso) -> str:
+    """Label da metrica: comandos desconhecidos sao agrupados para nao criar uma serie por mensagem"""
+    return comando if comando in ["turno", "posicao", "turma"] or comando in curso.manager.turnos else "desconhecido"
+
+async def curso_atual(connection: HTTPConnection) -> AsyncIterator[Curso]:
+    """O curso do prefixo /{curso}, ou o padrao; enquanto a rota roda o curso nao e descarregado"""
+    nome = connection.path_params.get("curso")
+    curso = padrao if nome is None else await cursos.get(nome)
+    if curso is None:
+        if connection.scope["type"] == "websocket":
+            raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Curso nao existe")
+        raise HTTPException(status_code=404, detail="Curso nao existe")
+
+    curso.in_use += 1
+    try:
+        yield curso
+    finally:
+        curso.in_use -= 1
+
+# as rotas de um curso, incluidas sem prefixo (curso padrao) e com /{curso}
+router = APIRouter()
+
+@app.get("/metrics")
+async def get_metrics():
+    """Metricas no formato texto do Prometheus"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/{cpf}")
 async def get_root(cpf: str):
@@ -85,105 +159,141 @@ async def get_root(cpf: str):
     return HTMLResponse(html)
 
 
-@app.get("/api/vagas/turno")
-async def api_vagas_turno():
-    """Retorna as vagas dos turnos"""
-    matutino = Turno.from_string(await file_read(MATUTINO_FILE_PATH))
-    matutino_vagas = 0
-    for t in matutino.turmas:
-        matutino_vagas += t.verde
-
-    vespertino = Turno.from_string(await file_read(VESPERTINO_FILE_PATH))
-    vespertino_vagas = 0
-    for t in vespertino.turmas:
-        vespertino_vagas += t.verde
-
+@router.get("/api/vagas/turno")
+async def api_vagas_turno(curso: Curso = Depends(curso_atual)):
+    """Retorna as vagas de cada turno"""
+    return {nome: turno.soma for nome, turno in curso.vagas.turnos.items()}
+
+
+@router.get("/api/vagas/{turno}")
+async def api_vagas_turmas(turno: str, curso: Curso = Depends(curso_atual)):
+    """Retorna as vagas de cada turma do turno"""
+    if turno not in curso.vagas.turnos:
+        raise HTTPException(status_code=404, detail="Turno nao existe")
+
+    return {t.name: t.verde for t in curso.vagas.get(turno).turmas}
+
+
+@router.get("/api/fila")
+async def api_fila(curso: Curso = Depends(curso_atual)):
+    """Retorna o estado das filas e a taxa de admissao de cada turno"""
+    filas = {}
+    for turno in curso.manager.all_turnos():
+        filas[turno.name] = {
+                "escolhendo": turno.choosing,
+                "admitidos": turno.admissions.total,
+                "admissoes_por_segundo": turno.admissions.rate(),
+        }
+
+    return filas
+
+
+@router.get("/api/relatorio")
+async def api_relatorio(formato: str = "csv", curso: Curso = Depends(curso_atual)):
+    """Matriculados por turma, gerado aos poucos enquanto e enviado"""
+    if formato not in FORMATOS:
+        raise HTTPException(status_code=400, detail="Formato deve ser csv ou ndjson")
+
+    async def stream():
+        # a dependencia termina antes do corpo: o curso fica em uso ate o fim do envio
+        curso.in_use += 1
+        try:
+            async for chunk in relatorio(curso.storage, turmas_do_relatorio(curso.storage.turnos, curso.ordem_turmas), formato):
+                yield chunk
+        finally:
+            curso.in_use -= 1
+
+    return StreamingResponse(stream(), media_type=FORMATOS[formato])
+
+
+@router.post("/api/cadastro", status_code=status.HTTP_201_CREATED)
+async def api_cadastro_lote(request: Request, curso: Curso = Depends(curso_atual)):
+    """Cadastra uma lista de cpfs: array JSON ou um cpf por linha"""
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            cpfs, invalidos = cpfs_from_json(await request.body())
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"JSON invalido: {e}")
+    else:
+        cpfs = []
+        invalidos = []
+        resto = ""
+        # um caractere de varios bytes pode ficar dividido entre dois pedacos do corpo
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+            async for chunk in request.stream():
+                lines = (resto + decoder.decode(chunk)).split("\n")
+                resto = lines.pop()
+                cpfs.extend(lines)
+            resto += decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="corpo nao e UTF-8")
+        cpfs.append(resto)
+        cpfs = [cpf.strip() for cpf in cpfs if cpf.strip() != ""]
+
+    invalidos += [cpf for cpf in cpfs if not cpf_valido(cpf)]
+    cadastrados, duplicados = await curso.storage.cadastro_lote([cpf for cpf in cpfs if cpf_valido(cpf)], curso.ordem_turmas)
     return {
-            "matutino": matutino_vagas,
-            "vespertino": vespertino_vagas,
+            "cadastrados": cadastrados,
+            "duplicados": duplicados,
+            "invalidos": invalidos,
     }
 
-
-@app.get("/api/vagas/matutino")
-async def api_vagas_matutino():
-    """Retorna as vagas da turma do matutino"""
-    turno = Turno.from_string(await file_read(MATUTINO_FILE_PATH))
-    vagas = {}
-    for idx, t in enumerate(turno.turmas):
-        vagas[chr(ord("A")+idx)] = t.verde
-
-    return vagas
-
-@app.get("/api/vagas/vespertino")
-async def api_vagas_vespertino():
-    """Retorna as vagas da turma do vespertino"""
-    turno = Turno.from_string(await file_read(VESPERTINO_FILE_PATH))
-    vagas = {}
-    for idx, t in enumerate(turno.turmas):
-        vagas[chr(ord("E")+idx)] = t.verde
-
-    return vagas
-
-
-@app.post("/api/cadastro/{cpf}", status_code=status.HTTP_201_CREATED)
-async def api_cadastro(cpf: str):
+@router.post("/api/cadastro/{cpf}", status_code=status.HTTP_201_CREATED)
+async def api_cadastro(cpf: str, curso: Curso = Depends(curso_atual)):
     """Cadastra cpf"""
-    student_path = path_from_cpf(cpf)
-    if await file_exist(student_path):
-        raise HTTPException(status_code=404, detail="Estudante ja cadastrado")
+    if not cpf_valido(cpf):
+        raise HTTPException(status_code=422, detail="CPF invalido")
 
-    student = Aluno(turma="X")
-    cnt = await file_count_files_in_dir(ALUNO_DIR)
-
-    turma = ordem_turmas[cnt % len(ordem_turmas)]
-
-    turno_path = (
-        MATUTINO_FILE_PATH
-        if turma in matutino
-        else VESPERTINO_FILE_PATH
-    )
+    if await curso.storage.cadastro(cpf, curso.ordem_turmas) is None:
+        raise HTTPException(status_code=404, detail="Estudante ja cadastrado")
 
-    turno = Turno.from_string(await file_read(turno_path))
-    t_idx = -1
-    for idx, t in enumerate(turno.turmas):
-        if t.name == turma:
-            t_idx  = idx
+@router.websocket("/ws/vagas")
+async def ws_vagas(websocket: WebSocket, curso: Curso = Depends(curso_atual)):
+    await websocket.accept()
+    subscriber = await curso.manager.vagas_broadcaster.subscribe(websocket)
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        curso.manager.vagas_broadcaster.unsubscribe(subscriber)
 
-    turno.turmas[t_idx].verde += 1
-    await file_write(student_path, student.to_string())
-    await file_write(turno_path, turno.to_string())
+@router.websocket("/ws/matricula/{cpf}")
+async def ws_matricula(websocket: WebSocket, cpf: str, protocolo: str = "texto", curso: Curso = Depends(curso_atual)):
+    """Comandos em texto ou, com ?protocolo=json, pedidos com id; ver protocolo.py"""
+    manager = curso.manager
+    if protocolo not in PROTOCOLOS:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Protocolo desconhecido")
 
-@app.websocket("/ws/matricula/{cpf}")
-async def ws_matricula(websocket: WebSocket, cpf: str):
-    student_path = path_from_cpf(cpf)
-    if not await file_exist(student_path):
+    student = await curso.storage.aluno(cpf)
+    if student is None:
         raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="CPF nao foi cadastrado")
 
-    student = Aluno.from_string(await file_read(student_path))
     if student.turma != "X":
         raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="CPF ja foi matriculado")
 
-    client_connection = ClientConnection(socket=websocket, cpf=cpf)
-    await manager.connect(client_connection)
+    client_connection = await manager.connect(websocket, cpf, protocolo)
     try:
         while True:
             data = await websocket.receive_text()
-
-            student = Aluno.from_string(await file_read(student_path))
-            if student.turma != "X":
-                raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="CPF ja foi matriculado")
-
-            if data == "turno":
-                await manager.matricula_turno(client_connection)
-            elif data == "matutino":
-                await manager.matricula_matutino(client_connection)
-            elif data == "vespertino":
-                await manager.matricula_vespertino(client_connection)
-            elif data.startswith("turma:"):
-                _, turma = data.split(":")
-                await manager.matricula_turma(client_connection, turma.strip())
-            else:
-                await manager.command_not_found(client_connection, data)
+            try:
+                pedidos = ler(protocolo, data)
+            except ValueError as e:
+                client_connection.reply(f"error: {e}")
+                continue
+
+            # varios pedidos numa mensagem, ou mandados sem esperar resposta, sao executados em ordem
+            for pedido in pedidos:
+                if client_connection.matriculado:
+                    raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="CPF ja foi matriculado")
+                with command_seconds.time(nome_comando(pedido.comando, curso)):
+                    await manager.comando(client_connection, pedido)
 
     except WebSocketDisconnect:
-        await manager.disconnect(client_connection)
+        pass
+    finally:
+        await manager.detach(client_connection, websocket)
+
+
+app.include_router(router)
+app.include_router(router, prefix="/{curso}")
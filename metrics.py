@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import bisect, time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+from timers import monotonic
+
+
+class RateMeter:
+    """Eventos por segundo numa janela deslizante"""
+    def __init__(self, window: float = 10.0):
+        self.window = window
+        self.events: deque[tuple[float, int]] = deque()
+        self.in_window = 0
+        self.total = 0
+
+    def trim(self, now: float):
+        while len(self.events) > 0 and self.events[0][0] <= now - self.window:
+            _, n = self.events.popleft()
+            self.in_window -= n
+
+    def mark(self, n: int = 1):
+        now = monotonic()
+        self.trim(now)
+        self.events.append((now, n))
+        self.in_window += n
+        self.total += n
+
+    def rate(self) -> float:
+        self.trim(monotonic())
+        return self.in_window / self.window
+
+
+# limites dos histogramas em segundos, de 100us a 10s
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, n: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + n
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Contagem por faixa de duracao; observe() custa uma busca binaria nos limites"""
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # por labels: contagem em cada faixa (a ultima e +Inf) e a soma das duracoes
+        self.counts: dict[tuple[str, ...], list[int]] = {}
+        self.sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *labels: str):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - begin, *labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for labels, counts in sorted(self.counts.items()):
+            total = 0
+            for le, count in zip([str(b) for b in self.buckets] + ["+Inf"], counts):
+                total += count
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (le,))} {total}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {self.sums[labels]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {total}")
+        return lines
+
+
+class Collector:
+    """Valores lidos so na hora de exportar, como o tamanho das filas"""
+    def __init__(self, name: str, help: str, type: str, labels: tuple[str, ...], collect: Callable[[], Iterable[tuple[tuple[str, ...], float]]]):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = labels
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, value in self.collect():
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Registry:
+    """Metricas no formato texto do Prometheus, servidas em /metrics"""
+    def __init__(self):
+        self.metrics: dict[str, Counter | Histogram | Collector] = {}
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, help, labels))
+
+    def collector(self, name: str, help: str, type: str, labels: tuple[str, ...], collect) -> Collector:
+        return self.register(Collector(name, help, type, labels, collect))
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+io_seconds = registry.histogram("matricula_io_seconds", "Duracao das operacoes de disco e banco", ("op",))
+command_seconds = registry.histogram("matricula_comando_seconds", "Duracao de cada comando do websocket ate a resposta", ("comando",))
+send_seconds = registry.histogram("matricula_envio_seconds", "Duracao dos envios iniciados pelo servidor (vez, posicao, remove)")
+timeouts = registry.counter("matricula_prazos_expirados_total", "Clientes removidos por nao escolher no prazo", ("turno",))
+slow_consumers = registry.counter("matricula_clientes_lentos_total", "Filas de saida cheias, por acao tomada", ("acao",))
+rejected = registry.counter("matricula_recusados_total", "Requisicoes e websockets recusados pelos limites", ("motivo",))
+sessions_expired = registry.counter("matricula_sessoes_expiradas_total", "Clientes que cairam e nao reconectaram no prazo")
@@ -1,8 +1,15 @@
 from __future__ import annotations
 
-from config import MATUTINO_FILE_PATH, VESPERTINO_FILE_PATH
-from utils import file_read
-from dataclasses import dataclass
+import threading
+from typing import Awaitable, Callable
+
+from dataclasses import dataclass, field
+from enum import Enum
+
+
+class AlunoStatus(Enum):
+    WAITING = 0
+    CHOOSING = 1
 
 @dataclass
 class Aluno:
@@ -24,6 +31,31 @@ class Turma:
     name: str
     verde: int
     vermelho: int
+    # protege verde/vermelho; nunca e segurado durante um await
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    # turno cuja capacidade acompanha as vagas desta turma
+    turno: Turno | None = field(default=None, repr=False, compare=False)
+
+    def set(self, verde: int, vermelho: int):
+        """Toda mudanca de vagas passa por aqui para manter a capacidade do turno em dia"""
+        if self.turno is None:
+            self.verde, self.vermelho = verde, vermelho
+            return
+        with self.turno.lock:
+            antes = self.verde
+            self.verde, self.vermelho = verde, vermelho
+            self.turno.vaga_mudou(antes, verde)
+
+    def abrir_vaga(self):
+        """Deve ser chamado com o lock da turma"""
+        self.set(self.verde + 1, self.vermelho)
+
+    def reservar(self) -> bool:
+        """Ocupa uma vaga se houver; deve ser chamado com o lock da turma"""
+        if self.verde == 0:
+            return False
+        self.set(self.verde - 1, self.vermelho + 1)
+        return True
 
     @staticmethod
     def from_string(content: str) -> Turma:
@@ -35,7 +67,35 @@ class Turma:
 
 @dataclass
 class Turno:
+    """Turmas de um turno com a capacidade guardada: soma das vagas e a menor
+    quantidade de vagas entre as turmas que ainda tem alguma.
+
+    Os dois valores sao atualizados a cada mudanca de uma turma; so quando a
+    turma que tinha o minimo muda as turmas sao percorridas de novo.
+    """
     turmas: list[Turma]
+    soma: int = field(default=0, init=False, compare=False)
+    minimo: int = field(default=0, init=False, compare=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        for t in self.turmas:
+            t.turno = self
+        with self.lock:
+            self.recalcular()
+
+    def recalcular(self):
+        """Deve ser chamado com o lock do turno"""
+        self.soma = sum(t.verde for t in self.turmas)
+        self.minimo = min((t.verde for t in self.turmas if t.verde != 0), default=0)
+
+    def vaga_mudou(self, antes: int, depois: int):
+        """Deve ser chamado com o lock do turno"""
+        self.soma += depois - antes
+        if depois != 0 and (self.minimo == 0 or depois < self.minimo):
+            self.minimo = depois
+        elif antes == self.minimo and depois != antes:
+            self.minimo = min((t.verde for t in self.turmas if t.verde != 0), default=0)
 
     @staticmethod
     def from_string(content: str) -> Turno:
@@ -46,31 +106,81 @@ class Turno:
     def to_string(self) -> str:
         return "\n".join([t.to_string() for t in self.turmas])
 
-
-async def get_turnos_capacity() -> int:
-    def cnt_capacity(turno: Turno) -> int:
-        sum = 0
-        for t in turno.turmas:
-            sum += t.verde
-        return sum
-    cap_mat = cnt_capacity(Turno.from_string(await file_read(MATUTINO_FILE_PATH)))
-    cap_vesp = cnt_capacity(Turno.from_string(await file_read(VESPERTINO_FILE_PATH)))
-    if cap_mat == 0 and cap_vesp == 0: return 0
-    elif cap_mat == 0 : return cap_vesp
-    elif cap_vesp == 0: return cap_mat
-
-    return min(cap_mat, cap_vesp)
+class Vagas:
+    """Estado dos turnos em memoria, carregado pelo armazenamento.
+
+    Com varios workers os contadores autoritativos ficam no banco SQLite
+    compartilhado e este objeto so guarda a ultima leitura.
+    """
+    def __init__(self):
+        self.turnos: dict[str, Turno] = {}
+        # busca direta pelo nome da turma
+        self.turmas: dict[str, Turma] = {}
+        self.turno_da_turma: dict[str, str] = {}
+        self.source = None
+        self.listeners: list[Callable[[], None]] = []
+
+    def load(self, turnos: dict[str, Turno]):
+        """Troca os turnos carregados pelo armazenamento, indexados pelo nome do turno"""
+        self.turnos = turnos
+        self.turmas = {t.name: t for turno in turnos.values() for t in turno.turmas}
+        self.turno_da_turma = {t.name: nome for nome, turno in turnos.items() for t in turno.turmas}
+
+    def changed(self):
+        """Avisa quem depende da capacidade que as vagas mudaram"""
+        for listener in self.listeners:
+            listener()
+
+    def share(self, source):
+        """Passa a ler as vagas do banco compartilhado, que ja foi semeado ao carregar o armazenamento"""
+        self.source = source
+        self.refresh()
+
+    def refresh(self):
+        """Rele as vagas do banco compartilhado; bloqueia, fora do event loop use asyncio.to_thread"""
+        if self.source is None:
+            return
+        rows = self.source.read_vagas()
+        # outro worker mudou as vagas: a capacidade guardada e recalculada de uma vez.
+        # O lock do turno basta para escrever; Turma.set tambem escreve com ele
+        for turno in self.turnos.values():
+            with turno.lock:
+                for name, verde, vermelho in rows:
+                    t = self.turmas.get(name)
+                    if t is not None and t.turno is turno:
+                        t.verde, t.vermelho = verde, vermelho
+                turno.recalcular()
+
+    def abrir_vaga(self, t: Turma):
+        """Deve ser chamado com o lock da turma"""
+        t.abrir_vaga()
+
+    def reservar(self, t: Turma, cpf: str) -> bool:
+        """Deve ser chamado com o lock da turma"""
+        return t.reservar()
+
+    def get(self, turno: str) -> Turno:
+        return self.turnos[turno]
+
+    def turma(self, name: str) -> Turma:
+        return self.turmas[name]
+
+vagas = Vagas()
+
+
+def get_turnos_capacity(vagas: Vagas) -> int:
+    """Menor soma de vagas entre os turnos que ainda tem vagas"""
+    return min((turno.soma for turno in vagas.turnos.values() if turno.soma != 0), default=0)
 
 def get_turno_capacity(turno: Turno) -> int:
-    values = [t.verde for t in turno.turmas if t.verde != 0]
-    if len(values) == 0: return 0
-    cap = values[0]
-    for c in values: cap = min(cap, c)
-    return cap
-
+    return turno.minimo
 
-async def get_matutino_capacity() -> int:
-    return get_turno_capacity(Turno.from_string(await file_read(MATUTINO_FILE_PATH)))
+def turnos_capacity_fn(vagas: Vagas) -> Callable[[], Awaitable[int]]:
+    async def get_capacity() -> int:
+        return get_turnos_capacity(vagas)
+    return get_capacity
 
-async def get_vespertino_capacity() -> int:
-    return get_turno_capacity(Turno.from_string(await file_read(VESPERTINO_FILE_PATH)))
+def turno_capacity_fn(turno: str, vagas: Vagas) -> Callable[[], Awaitable[int]]:
+    async def get_capacity() -> int:
+        return get_turno_capacity(vagas.get(turno))
+    return get_capacity
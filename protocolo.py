@@ -0,0 +1,93 @@
+"""Protocolos do /ws/matricula.
+
+"texto" e o original: o comando e a mensagem ("turno", "matutino",
+"turma:A", "posicao") e as respostas sao "ok", "error: ...", "vez", "remove"
+e "posicao:N eta:S". "json" (versao VERSAO) aceita um pedido ou uma lista
+de pedidos por mensagem, cada um com um id opcional,
+
+    {"v": 1, "id": 7, "comando": "turma", "turma": "A"}
+
+e responde com o mesmo id; eventos que nao respondem a um pedido (vez,
+remove, posicao periodica) vao com id null:
+
+    {"v": 1, "id": 7, "tipo": "erro", "erro": "turma cheia"}
+    {"v": 1, "id": null, "tipo": "posicao", "posicao": 3, "eta": 12}
+
+Por dentro as mensagens sao sempre as do protocolo texto; codificar()
+traduz na hora de enfileirar.
+"""
+from __future__ import annotations
+
+import json
+from typing import NamedTuple
+
+VERSAO = 1
+PROTOCOLOS = ["texto", "json"]
+
+
+class Pedido(NamedTuple):
+    id: int | str | None
+    comando: str
+    argumento: str | None = None
+
+
+def ler(protocolo: str, data: str) -> list[Pedido]:
+    """Os pedidos de uma mensagem recebida; ValueError se ela nao segue o protocolo"""
+    if protocolo == "texto":
+        comando, _, argumento = data.partition(":")
+        if comando == "turma":
+            return [Pedido(None, comando, argumento.strip())]
+        return [Pedido(None, data)]
+
+    try:
+        pedidos = json.loads(data)
+    except json.JSONDecodeError:
+        raise ValueError("json invalido")
+    if not isinstance(pedidos, list):
+        pedidos = [pedidos]
+    return [ler_json(pedido) for pedido in pedidos]
+
+
+def ler_json(pedido) -> Pedido:
+    if not isinstance(pedido, dict):
+        raise ValueError("pedido deve ser um objeto")
+    if pedido.get("v") != VERSAO:
+        raise ValueError(f"versao nao suportada {pedido.get('v')}")
+    id = pedido.get("id")
+    if id is not None and (not isinstance(id, (int, str)) or isinstance(id, bool)):
+        raise ValueError("id deve ser numero ou texto")
+    comando = pedido.get("comando")
+    if not isinstance(comando, str):
+        raise ValueError("pedido sem comando")
+    argumento = pedido.get("turma") if comando == "turma" else None
+    if comando == "turma" and not isinstance(argumento, str):
+        raise ValueError("comando turma sem turma")
+    return Pedido(id, comando, argumento)
+
+
+def tipo(mensagem: str) -> str:
+    """Tipo de uma mensagem ja codificada em qualquer dos protocolos"""
+    if mensagem.startswith("{"):
+        return json.loads(mensagem)["tipo"]
+    if mensagem.startswith("error:"):
+        return "erro"
+    return mensagem.split(":")[0]
+
+
+def codificar(protocolo: str, mensagem: str, id: int | str | None = None) -> str:
+    if protocolo == "texto":
+        return mensagem
+
+    resposta = {"v": VERSAO, "id": id}
+    if mensagem.startswith("error:"):
+        resposta["tipo"] = "erro"
+        resposta["erro"] = mensagem[len("error:"):].strip()
+    elif mensagem.startswith("posicao:"):
+        posicao, eta = mensagem.split(" ")
+        resposta["tipo"] = "posicao"
+        resposta["posicao"] = int(posicao.split(":")[1])
+        eta = eta.split(":")[1]
+        resposta["eta"] = None if eta == "?" else int(eta)
+    else:
+        resposta["tipo"] = mensagem
+    return json.dumps(resposta)
@@ -0,0 +1,50 @@
+"""Lista de matriculados por turma, em CSV (turma,cpf) ou NDJSON ({"turma": ..., "cpf": ...}).
+
+Uso: python relatorio.py [--formato csv|ndjson] [--saida arquivo]
+As turmas saem na ordem de ordem_turmas e depois as que faltarem. Os cpfs de
+cada turma vem do armazenamento em lotes: com STORAGE=sqlite a memoria nao
+cresce com o numero de alunos (o armazenamento em arquivos ja mantem todos em
+memoria). Com o servidor no ar use GET /api/relatorio?formato=...
+"""
+import argparse, asyncio, json, sys
+from typing import AsyncIterator
+
+from config import ordem_turmas, turnos
+from storage import FileStorage, SqliteStorage, storage
+
+FORMATOS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def turmas_do_relatorio(turnos: dict[str, list[str]], ordem_turmas: list[str]) -> list[str]:
+    return list(dict.fromkeys([*ordem_turmas, *[turma for turmas in turnos.values() for turma in turmas]]))
+
+
+async def relatorio(storage: FileStorage | SqliteStorage, turmas: list[str], formato: str) -> AsyncIterator[str]:
+    """Um pedaco de texto por lote de cpfs"""
+    if formato == "csv":
+        yield "turma,cpf\n"
+    for turma in turmas:
+        async for cpfs in storage.alunos_da_turma(turma):
+            if formato == "csv":
+                yield "".join(f"{turma},{cpf}\n" for cpf in cpfs)
+            else:
+                yield "".join(json.dumps({"turma": turma, "cpf": cpf}) + "\n" for cpf in cpfs)
+
+
+async def main(args):
+    storage.load()
+    out = sys.stdout if args.saida is None else open(args.saida, "w")
+    try:
+        async for chunk in relatorio(storage, turmas_do_relatorio(turnos, ordem_turmas), args.formato):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--formato", choices=list(FORMATOS), default="csv")
+    parser.add_argument("--saida", help="arquivo de saida; sem ele escreve na saida padrao")
+    asyncio.run(main(parser.parse_args()))
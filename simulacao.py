@@ -0,0 +1,271 @@
+"""Simulacao das filas de matricula em tempo virtual, repetindo o comportamento de cada aluno de um traco.
+
+Uso: python simulacao.py [traco.ndjson] [--gerar N] [--semente S] [--salvar traco.ndjson]
+O ConnectionManager roda com sockets falsos num event loop cujo relogio pula
+para o proximo timer quando nao ha nada para executar: prazos de escolha,
+reconexao e envio de posicoes acontecem em tempo virtual e horas de
+matricula levam segundos. Cada linha do traco e um aluno:
+
+    {"cpf": "7", "chega": 3.2, "pensa": [4.1, 7.0], "turnos": ["matutino", "vespertino"],
+     "turmas": ["B", "A", "E"], "abandona": null}
+
+O aluno chega, pede "turno", espera a vez, pensa e tenta os turnos na
+ordem; na vez seguinte pensa de novo e tenta as turmas do turno em que
+entrou. abandona "turno" ou "turma" para de responder ao receber a vez
+naquela etapa (o prazo expira); "cai" fecha o socket esperando a vez e
+nao volta. Sem arquivo o traco e gerado com --gerar alunos.
+Mostra a espera pela vez, admissoes fora da ordem de chegada e o uso das vagas.
+"""
+from __future__ import annotations
+
+import argparse, asyncio, json, math, random, selectors, shutil, tempfile, time
+
+from config import SEP, ordem_turmas, turnos
+from connection import ConnectionManager
+from model import Vagas
+from protocolo import Pedido
+from storage import FileStorage
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """Quando o loop so esperaria o proximo timer, adianta o relogio virtual ate ele"""
+    def __init__(self, loop: VirtualTimeLoop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout: float | None = None):
+        if timeout is None or self.loop.in_executor > 0:
+            # sem timers, ou com trabalho em outra thread: espera de verdade, sem mexer no relogio
+            return super().select(timeout)
+        events = super().select(0)
+        if len(events) == 0 and len(self.loop._ready) == 0:
+            # so falta o proximo timer. Um prazo a menos de um passo do float do relogio
+            # vira timeout 0 e dispararia sem o relogio chegar nele: o relogio sempre anda
+            self.loop.virtual = max(self.loop.virtual + timeout, math.nextafter(self.loop.virtual, math.inf))
+        return events
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Event loop com relogio virtual; o trabalho em threads (to_thread) nao gasta tempo virtual"""
+    def __init__(self):
+        self.virtual = 0.0
+        self.in_executor = 0
+        super().__init__(VirtualSelector(self))
+        # o loop dispara timers ate _clock_resolution adiantados; com o relogio parado quem espera
+        # um prazo a menos disso (DeadlineScheduler) acordaria cedo para sempre
+        self._clock_resolution = 0.0
+
+    def time(self) -> float:
+        return self.virtual
+
+    def run_in_executor(self, executor, func, *args):
+        self.in_executor += 1
+        future = super().run_in_executor(executor, func, *args)
+        future.add_done_callback(self.executor_done)
+        return future
+
+    def executor_done(self, future: asyncio.Future):
+        self.in_executor -= 1
+
+
+class SimStorage(FileStorage):
+    """Armazenamento em arquivos que nao grava o journal: a simulacao nao espera o disco"""
+    async def commit(self):
+        self.journal.pending.clear()
+
+
+class Aluno:
+    """Socket falso de um aluno, que reage ao que o servidor envia como manda o traco"""
+    def __init__(self, manager: ConnectionManager, vagas: Vagas, spec: dict):
+        self.manager = manager
+        self.vagas = vagas
+        self.spec = spec
+        self.cpf = spec["cpf"]
+        self.inbox: asyncio.Queue[str] = asyncio.Queue()
+        # espera pela vez na fila de turnos e na de turmas
+        self.espera: list[float] = []
+        self.admitido: float | None = None
+        self.desfecho = ""
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        self.inbox.put_nowait(data)
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def receive(self) -> str:
+        while True:
+            message = await self.inbox.get()
+            if not message.startswith("posicao:"):
+                return message
+
+    async def command(self, client, comando: str, argumento: str | None = None) -> str:
+        await self.manager.comando(client, Pedido(None, comando, argumento))
+        return await self.receive()
+
+    async def wait_vez(self) -> bool:
+        begin = asyncio.get_running_loop().time()
+        if await self.receive() != "vez":
+            return False
+        self.espera.append(asyncio.get_running_loop().time() - begin)
+        return True
+
+    async def choose(self, client, etapa: str, pensa: float, opcoes: list[tuple[str, str | None]]) -> bool:
+        """Na vez: abandona, ou pensa e tenta as opcoes na ordem ate um "ok" """
+        if self.spec["abandona"] == etapa:
+            # nao responde: so sai da fila quando o prazo expira
+            await self.receive()
+            self.desfecho = f"prazo_{etapa}"
+            return False
+        await asyncio.sleep(pensa)
+        for comando, argumento in opcoes:
+            reply = await self.command(client, comando, argumento)
+            if reply == "ok":
+                return True
+            if reply == "error: nao esta na sua vez":
+                # pensou alem do prazo
+                self.desfecho = f"prazo_{etapa}"
+                return False
+        self.desfecho = "lotado"
+        return False
+
+    async def run(self):
+        spec = self.spec
+        await asyncio.sleep(spec["chega"])
+        client = await self.manager.connect(self, self.cpf)
+        try:
+            await self.command(client, "turno")
+            if spec["abandona"] == "cai":
+                self.desfecho = "caiu"
+                return
+            if not await self.wait_vez():
+                return
+            self.admitido = asyncio.get_running_loop().time()
+            if not await self.choose(client, "turno", spec["pensa"][0], [(nome, None) for nome in spec["turnos"]]):
+                return
+            if not await self.wait_vez():
+                return
+            turno = await self.manager.current_turno(client)
+            opcoes = [("turma", turma) for turma in spec["turmas"] if self.vagas.turno_da_turma.get(turma) == turno.name]
+            if await self.choose(client, "turma", spec["pensa"][1], opcoes):
+                self.desfecho = "matriculado"
+        finally:
+            await self.manager.detach(client, self)
+
+
+def gerar(alunos: int, semente: int = 0, abertura: float = 60.0) -> list[dict]:
+    """Traco sintetico: chegadas com media de abertura segundos, alguns segundos para escolher,
+    2% que caem esperando e 2% que abandonam em cada etapa"""
+    rng = random.Random(semente)
+    traco = []
+    for i in range(alunos):
+        preferencia = rng.sample(list(turnos), len(turnos))
+        sorteio = rng.random()
+        abandona = "cai" if sorteio < 0.02 else "turno" if sorteio < 0.04 else "turma" if sorteio < 0.06 else None
+        traco.append({
+            "cpf": str(i),
+            "chega": round(rng.expovariate(1 / abertura), 3),
+            "pensa": [round(rng.lognormvariate(1.5, 0.5), 3) for _ in range(2)],
+            "turnos": preferencia,
+            "turmas": [turma for nome in preferencia for turma in rng.sample(turnos[nome], len(turnos[nome]))],
+            "abandona": abandona,
+        })
+    return traco
+
+
+def inversoes(ordem: list[int]) -> int:
+    """Pares fora de ordem, por merge sort"""
+    if len(ordem) < 2:
+        return 0
+    meio = len(ordem) // 2
+    esquerda, direita = ordem[:meio], ordem[meio:]
+    total = inversoes(esquerda) + inversoes(direita)
+    esquerda.sort()
+    direita.sort()
+    j = 0
+    for valor in esquerda:
+        while j < len(direita) and direita[j] < valor:
+            j += 1
+        total += j
+    return total
+
+
+def percentil(values: list[float], p: int) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * p // 100)]
+
+
+async def simular(traco: list[dict]) -> dict:
+    """Roda o traco num ConnectionManager novo; deve rodar num VirtualTimeLoop"""
+    data_dir = tempfile.mkdtemp(prefix="simulacao_") + SEP
+    vagas = Vagas()
+    storage = SimStorage(data_dir, turnos, vagas)
+    storage.load()
+    await storage.cadastro_lote([spec["cpf"] for spec in traco], ordem_turmas)
+    manager = ConnectionManager(None, vagas, storage)
+    vagas.listeners.append(manager.notify_all)
+    manager.start()
+
+    alunos = [Aluno(manager, vagas, spec) for spec in sorted(traco, key=lambda spec: spec["chega"])]
+    begin = time.perf_counter()
+    await asyncio.gather(*[aluno.run() for aluno in alunos])
+    real = time.perf_counter() - begin
+    manager.stop()
+    storage.close()
+    shutil.rmtree(data_dir)
+
+    # posicao de cada aluno na ordem de chegada, na ordem em que receberam a vez no turno
+    chegada = {aluno.cpf: i for i, aluno in enumerate(alunos)}
+    admitidos = sorted([a for a in alunos if a.admitido is not None], key=lambda a: a.admitido)
+    desfechos: dict[str, int] = {}
+    for aluno in alunos:
+        desfechos[aluno.desfecho] = desfechos.get(aluno.desfecho, 0) + 1
+    total = sum(t.verde + t.vermelho for turno in vagas.turnos.values() for t in turno.turmas)
+    ocupadas = sum(t.vermelho for turno in vagas.turnos.values() for t in turno.turmas)
+    espera = {
+        etapa: [aluno.espera[i] for aluno in alunos if len(aluno.espera) > i]
+        for i, etapa in enumerate(["turno", "turma"])
+    }
+    return {
+        "alunos": len(alunos),
+        "tempo_virtual_s": round(asyncio.get_running_loop().time(), 3),
+        "tempo_real_s": round(real, 3),
+        "desfechos": desfechos,
+        "espera_vez_s": {
+            etapa: {f"p{p}": round(percentil(valores, p), 3) for p in [50, 90, 99, 100]}
+            for etapa, valores in espera.items()
+        },
+        "admissoes_fora_de_ordem": inversoes([chegada[aluno.cpf] for aluno in admitidos]),
+        "vagas": total,
+        "vagas_ocupadas": ocupadas,
+        "uso_das_vagas": round(ocupadas / total, 4) if total > 0 else 0.0,
+    }
+
+
+def rodar(traco: list[dict]) -> dict:
+    with asyncio.Runner(loop_factory=VirtualTimeLoop) as runner:
+        return runner.run(simular(traco))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("traco", nargs="?", help="arquivo NDJSON com um aluno por linha")
+    parser.add_argument("--gerar", type=int, default=50000, help="alunos do traco sintetico, sem arquivo")
+    parser.add_argument("--semente", type=int, default=0)
+    parser.add_argument("--salvar", help="grava o traco usado")
+    args = parser.parse_args()
+
+    if args.traco is not None:
+        with open(args.traco) as f:
+            traco = [json.loads(line) for line in f if line.strip() != ""]
+    else:
+        traco = gerar(args.gerar, args.semente)
+    if args.salvar is not None:
+        with open(args.salvar, "w") as f:
+            f.writelines(json.dumps(spec) + "\n" for spec in traco)
+    print(json.dumps(rodar(traco), indent=2))
@@ -0,0 +1,449 @@
+from __future__ import annotations
+
+import asyncio, os, sqlite3, threading
+from typing import AsyncIterator
+
+from config import DATA_DIR, SEP, JOURNAL_COMPACT_RECORDS, STORAGE, turnos
+from metrics import io_seconds
+from model import Aluno, Turma, Turno, Vagas, vagas
+from utils import file_write_atomic, path_from_cpf, path_from_turno
+
+
+class Journal:
+    """Log de operacoes apenas com append; cada linha e um registro"""
+    def __init__(self, path: str):
+        self.path = path
+        self.pending: list[str] = []
+        self.count = 0
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+
+    def append(self, record: str):
+        with self.lock:
+            self.pending.append(record)
+            self.count += 1
+
+    def write_pending(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            content = "".join(record + "\n" for record in self.pending)
+            self.pending = []
+            with io_seconds.time("journal"):
+                self.file.write(content)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    async def commit(self):
+        """Espera ate que os registros adicionados estejam no disco"""
+        await asyncio.to_thread(self.write_pending)
+
+    def close(self):
+        self.write_pending()
+        self.file.close()
+
+    @staticmethod
+    def read(path: str) -> list[list[str]]:
+        if not os.path.exists(path):
+            return []
+        with open(path, "r") as f:
+            content = f.read()
+        records = []
+        for line in content.split("\n"):
+            fields = line.split()
+            # a ultima linha pode estar incompleta se o processo caiu no meio da escrita
+            if len(fields) != 5 or not fields[3].isdigit() or not fields[4].isdigit():
+                continue
+            records.append(fields)
+        return records
+
+
+class FileStorage:
+    """Snapshot no formato de arquivos original mais um journal das operacoes.
+
+    Cada registro do journal guarda o valor final da turma alterada, entao
+    reaplicar um registro que ja esta no snapshot nao muda o resultado.
+    """
+    def __init__(self, data_dir: str = DATA_DIR, turnos: dict[str, list[str]] = turnos, vagas: Vagas = vagas):
+        self.data_dir = data_dir
+        self.aluno_dir = data_dir + "aluno" + SEP
+        self.journal_path = data_dir + "journal"
+        self.turnos = turnos
+        self.vagas = vagas
+        self.alunos: dict[str, Aluno] = {}
+        self.alunos_dirty: set[str] = set()
+        self.journal: Journal | None = None
+        self.compacting = False
+        self.snapshot_lock = threading.Lock()
+        self.cadastro_lock = threading.Lock()
+        self.cadastros = 0
+
+    def load(self):
+        if self.journal is not None:
+            self.journal.close()
+
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+
+        if not os.path.exists(self.aluno_dir):
+            os.makedirs(self.aluno_dir)
+
+        carregados = {}
+        for nome, turmas in self.turnos.items():
+            salvas = {}
+            if os.path.exists(path_from_turno(nome, self.data_dir)):
+                with open(path_from_turno(nome, self.data_dir), "r") as f:
+                    salvas = {t.name: t for t in Turno.from_string(f.read()).turmas}
+            # turmas novas na configuracao comecam sem vagas
+            carregados[nome] = Turno(turmas=[salvas.get(t, Turma(name=t, verde=0, vermelho=0)) for t in turmas])
+        self.vagas.load(carregados)
+
+        self.alunos = {}
+        for cpf in os.listdir(self.aluno_dir):
+            if cpf.endswith(".tmp"):
+                continue
+            with open(path_from_cpf(cpf, self.aluno_dir), "r") as f:
+                self.alunos[cpf] = Aluno.from_string(f.read())
+        self.alunos_dirty = set()
+
+        # o journal rotacionado e mais antigo que o atual
+        journal_paths = [self.journal_path + ".old", self.journal_path]
+        for path in journal_paths:
+            for record in Journal.read(path):
+                self.apply(record)
+        self.vagas.refresh()
+        # cada cpf e cadastrado uma unica vez, entao a sequencia e o numero de alunos
+        self.cadastros = len(self.alunos)
+
+        self.compacting = False
+        self.write_snapshot(self.snapshot(), journal_paths)
+        self.journal = Journal(self.journal_path)
+
+    def apply(self, record: list[str]):
+        [op, cpf, turma, verde, vermelho] = record
+        self.alunos[cpf] = Aluno(turma="X" if op == "cadastro" else turma)
+        self.alunos_dirty.add(cpf)
+        if turma in self.vagas.turmas:
+            self.vagas.turma(turma).set(int(verde), int(vermelho))
+
+    def exists(self, cpf: str) -> bool:
+        return cpf in self.alunos
+
+    def get_aluno(self, cpf: str) -> Aluno:
+        return self.alunos[cpf]
+
+    async def aluno(self, cpf: str) -> Aluno | None:
+        return self.alunos.get(cpf)
+
+    def count_alunos(self) -> int:
+        return len(self.alunos)
+
+    async def alunos_da_turma(self, turma: str, lote: int = 1000) -> AsyncIterator[list[str]]:
+        """cpfs matriculados na turma em ordem, em lotes; os alunos ja estao em memoria"""
+        cpfs = sorted(cpf for cpf, aluno in self.alunos.items() if aluno.turma == turma)
+        for i in range(0, len(cpfs), lote):
+            yield cpfs[i:i + lote]
+
+    def next_cadastro(self, quantidade: int = 1) -> int:
+        """Reserva as proximas posicoes do rodizio; deve ser chamado com o cadastro_lock"""
+        cnt = self.cadastros
+        self.cadastros += quantidade
+        return cnt
+
+    async def cadastro(self, cpf: str, ordem_turmas: list[str]) -> str | None:
+        """Cadastra o cpf na proxima turma do rodizio; None se ja estava cadastrado"""
+        with self.cadastro_lock:
+            if cpf in self.alunos:
+                return None
+            turma = ordem_turmas[self.next_cadastro() % len(ordem_turmas)]
+            self.alunos[cpf] = Aluno(turma="X")
+            self.alunos_dirty.add(cpf)
+            t = self.vagas.turma(turma)
+            with t.lock:
+                self.vagas.abrir_vaga(t)
+                self.journal.append(f"cadastro {cpf} {turma} {t.verde} {t.vermelho}")
+        await self.commit()
+        self.vagas.changed()
+        return turma
+
+    async def cadastro_lote(self, cpfs: list[str], ordem_turmas: list[str]) -> tuple[int, list[str]]:
+        """Cadastra varios cpfs com um unico commit; devolve (cadastrados, duplicados)"""
+        novos = []
+        duplicados = []
+        with self.cadastro_lock:
+            vistos = set()
+            for cpf in cpfs:
+                if cpf in self.alunos or cpf in vistos:
+                    duplicados.append(cpf)
+                else:
+                    vistos.add(cpf)
+                    novos.append(cpf)
+
+            cnt = self.next_cadastro(len(novos))
+            for cpf in novos:
+                turma = ordem_turmas[cnt % len(ordem_turmas)]
+                cnt += 1
+                self.alunos[cpf] = Aluno(turma="X")
+                self.alunos_dirty.add(cpf)
+                t = self.vagas.turma(turma)
+                with t.lock:
+                    self.vagas.abrir_vaga(t)
+                    self.journal.append(f"cadastro {cpf} {turma} {t.verde} {t.vermelho}")
+        await self.commit()
+        self.vagas.changed()
+        return len(novos), duplicados
+
+    async def matricula(self, cpf: str, turma: str) -> bool:
+        t = self.vagas.turma(turma)
+        with t.lock:
+            if not self.vagas.reservar(t, cpf):
+                return False
+            self.alunos[cpf] = Aluno(turma=turma)
+            self.alunos_dirty.add(cpf)
+            self.journal.append(f"matricula {cpf} {turma} {t.verde} {t.vermelho}")
+        await self.commit()
+        self.vagas.changed()
+        return True
+
+    async def commit(self):
+        await self.journal.commit()
+        if self.journal.count >= JOURNAL_COMPACT_RECORDS and not self.compacting:
+            asyncio.create_task(self.compact())
+
+    def snapshot(self) -> dict[str, str]:
+        files = {path_from_turno(nome, self.data_dir): turno.to_string() for nome, turno in self.vagas.turnos.items()}
+        for cpf in self.alunos_dirty:
+            files[path_from_cpf(cpf, self.aluno_dir)] = self.alunos[cpf].to_string()
+        self.alunos_dirty = set()
+        return files
+
+    def rotate_journal(self):
+        self.compacting = True
+        self.journal.close()
+        os.replace(self.journal_path, self.journal_path + ".old")
+        self.journal = Journal(self.journal_path)
+
+    def write_snapshot(self, files: dict[str, str], journal_paths: list[str]):
+        with self.snapshot_lock, io_seconds.time("snapshot"):
+            # o journal so e apagado depois que todo o snapshot esta no disco
+            for path, content in files.items():
+                file_write_atomic(path, content)
+            for path in journal_paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.compacting = False
+
+    def close(self):
+        """Grava os registros pendentes; bloqueia"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    async def compact(self):
+        """Grava o estado atual no formato de arquivos e descarta o journal"""
+        if self.compacting:
+            return
+        files = self.snapshot()
+        self.rotate_journal()
+        await asyncio.to_thread(self.write_snapshot, files, [self.journal_path + ".old"])
+
+
+class SqliteStorage:
+    """Alunos, turmas e contador de cadastros em um banco SQLite.
+
+    Cada cadastro/matricula e uma transacao; as vagas continuam espelhadas em
+    memoria em model.vagas para as leituras.
+    """
+    def __init__(self, path: str, turnos: dict[str, list[str]] = turnos, vagas: Vagas = vagas):
+        self.path = path
+        self.data_dir = os.path.dirname(path) + SEP
+        self.turnos = turnos
+        self.vagas = vagas
+        self.db: sqlite3.Connection | None = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.db is not None:
+            self.db.close()
+
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+
+        self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS aluno (
+                cpf TEXT PRIMARY KEY,
+                turma TEXT NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS turma (
+                name TEXT PRIMARY KEY,
+                verde INTEGER NOT NULL,
+                vermelho INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS contador (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO contador (name, value) VALUES ('cadastros', 0);
+            CREATE INDEX IF NOT EXISTS aluno_turma ON aluno (turma, cpf);
+        """)
+        self.db.executemany("INSERT OR IGNORE INTO turma (name, verde, vermelho) VALUES (?, 0, 0)",
+                            [(t,) for turmas in self.turnos.values() for t in turmas])
+
+        self.vagas.load({nome: Turno(turmas=[Turma(name=t, verde=0, vermelho=0) for t in turmas])
+                         for nome, turmas in self.turnos.items()})
+        self.sync_vagas()
+
+    def sync_vagas(self):
+        for name, verde, vermelho in self.read_vagas():
+            # o banco pode ter turmas de uma configuracao anterior
+            if name in self.vagas.turmas:
+                self.vagas.turma(name).set(verde, vermelho)
+
+    def read_vagas(self) -> list[tuple[str, int, int]]:
+        with self.lock:
+            return self.db.execute("SELECT name, verde, vermelho FROM turma").fetchall()
+
+    def exists(self, cpf: str) -> bool:
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM aluno WHERE cpf = ?", (cpf,)).fetchone() is not None
+
+    def get_aluno(self, cpf: str) -> Aluno:
+        with self.lock:
+            [turma] = self.db.execute("SELECT turma FROM aluno WHERE cpf = ?", (cpf,)).fetchone()
+        return Aluno(turma=turma)
+
+    async def aluno(self, cpf: str) -> Aluno | None:
+        """Leitura fora do event loop: o lock do banco pode estar com uma transacao"""
+        def run():
+            with self.lock, io_seconds.time("sqlite_leitura"):
+                return self.db.execute("SELECT turma FROM aluno WHERE cpf = ?", (cpf,)).fetchone()
+        row = await asyncio.to_thread(run)
+        return None if row is None else Aluno(turma=row[0])
+
+    def count_alunos(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT value FROM contador WHERE name = 'cadastros'").fetchone()[0]
+
+    async def alunos_da_turma(self, turma: str, lote: int = 1000) -> AsyncIterator[list[str]]:
+        """cpfs matriculados na turma em ordem, lidos um lote por vez pelo indice (turma, cpf)"""
+        def run(depois: str) -> list[str]:
+            with self.lock, io_seconds.time("sqlite_leitura"):
+                rows = self.db.execute("SELECT cpf FROM aluno WHERE turma = ? AND cpf > ? ORDER BY cpf LIMIT ?",
+                                       (turma, depois, lote)).fetchall()
+            return [row[0] for row in rows]
+        depois = ""
+        while True:
+            cpfs = await asyncio.to_thread(run, depois)
+            if len(cpfs) == 0:
+                return
+            yield cpfs
+            depois = cpfs[-1]
+
+    def transaction_sync(self, fn):
+        with self.lock, io_seconds.time("sqlite"):
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self.db)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+
+    def set_turma(self, turma: str, values: tuple[int, int]):
+        """Espelha em memoria o valor gravado; chamado dentro da transacao para manter a ordem"""
+        t = self.vagas.turma(turma)
+        with t.lock:
+            t.set(*values)
+
+    def cadastro_sync(self, cpf: str, ordem_turmas: list[str]) -> str | None:
+        def run(db: sqlite3.Connection):
+            if db.execute("INSERT OR IGNORE INTO aluno (cpf, turma) VALUES (?, 'X')", (cpf,)).rowcount == 0:
+                return None
+            [cnt] = db.execute("""UPDATE contador SET value = value + 1 WHERE name = 'cadastros'
+                                  RETURNING value - 1""").fetchone()
+            turma = ordem_turmas[cnt % len(ordem_turmas)]
+            values = db.execute("""UPDATE turma SET verde = verde + 1 WHERE name = ?
+                                   RETURNING verde, vermelho""", (turma,)).fetchone()
+            self.set_turma(turma, values)
+            return turma
+
+        return self.transaction_sync(run)
+
+    def cadastro_lote_sync(self, cpfs: list[str], ordem_turmas: list[str]) -> tuple[int, list[str]]:
+        def run(db: sqlite3.Connection):
+            duplicados = []
+            aberturas = {}
+            [cnt] = db.execute("SELECT value FROM contador WHERE name = 'cadastros'").fetchone()
+            start = cnt
+            for cpf in cpfs:
+                if db.execute("INSERT OR IGNORE INTO aluno (cpf, turma) VALUES (?, 'X')", (cpf,)).rowcount == 0:
+                    duplicados.append(cpf)
+                    continue
+                turma = ordem_turmas[cnt % len(ordem_turmas)]
+                aberturas[turma] = aberturas.get(turma, 0) + 1
+                cnt += 1
+            db.execute("UPDATE contador SET value = ? WHERE name = 'cadastros'", (cnt,))
+            for turma, quantidade in aberturas.items():
+                values = db.execute("""UPDATE turma SET verde = verde + ? WHERE name = ?
+                                       RETURNING verde, vermelho""", (quantidade, turma)).fetchone()
+                self.set_turma(turma, values)
+            return cnt - start, duplicados
+
+        return self.transaction_sync(run)
+
+    def matricula_sync(self, cpf: str, turma: str) -> bool:
+        def run(db: sqlite3.Connection):
+            values = db.execute("""UPDATE turma SET verde = verde - 1, vermelho = vermelho + 1
+                                   WHERE name = ? AND verde > 0 RETURNING verde, vermelho""", (turma,)).fetchone()
+            if values is None:
+                return None
+            if db.execute("UPDATE aluno SET turma = ? WHERE cpf = ? AND turma = 'X'", (turma, cpf)).rowcount == 0:
+                raise sqlite3.IntegrityError(f"cpf {cpf} nao pode ser matriculado")
+            self.set_turma(turma, values)
+            return values
+
+        try:
+            return self.transaction_sync(run) is not None
+        except sqlite3.IntegrityError:
+            return False
+
+    async def cadastro(self, cpf: str, ordem_turmas: list[str]) -> str | None:
+        """Cadastra o cpf na proxima turma do rodizio; None se ja estava cadastrado"""
+        turma = await asyncio.to_thread(self.cadastro_sync, cpf, ordem_turmas)
+        self.vagas.changed()
+        return turma
+
+    async def cadastro_lote(self, cpfs: list[str], ordem_turmas: list[str]) -> tuple[int, list[str]]:
+        """Cadastra varios cpfs em uma transacao; devolve (cadastrados, duplicados)"""
+        result = await asyncio.to_thread(self.cadastro_lote_sync, cpfs, ordem_turmas)
+        self.vagas.changed()
+        return result
+
+    async def matricula(self, cpf: str, turma: str) -> bool:
+        ok = await asyncio.to_thread(self.matricula_sync, cpf, turma)
+        self.vagas.changed()
+        return ok
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    async def compact(self):
+        """Transfere o WAL para o arquivo principal do banco"""
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def new_storage(data_dir: str = DATA_DIR, turnos: dict[str, list[str]] = turnos, vagas: Vagas = vagas) -> FileStorage | SqliteStorage:
+    if STORAGE == "sqlite":
+        return SqliteStorage(data_dir + "alunos.sqlite", turnos, vagas)
+    return FileStorage(data_dir, turnos, vagas)
+
+storage = new_storage()
@@ -1,8 +1,22 @@
-import pytest, asyncio, os, shutil
+import pytest, asyncio, json, os, shutil
 from httpx import ASGITransport, AsyncClient
 from fastapi.testclient import TestClient
 
-from main import app, DATA_DIR, start_db
+from main import app, cursos, limites, manager, DATA_DIR, start_db
+from metrics import registry
+from connection import BufferedSocket, ConnectionManager, ClientConnection
+from coordination import SqliteCoordination
+from cursos import Curso
+from fila import Fila
+from limites import TokenBucket
+from model import Turno, vagas
+from storage import storage, SqliteStorage
+from utils import path_from_turno
+from config import CURSOS_DIR, JOURNAL_FILE_PATH, OUTBOX_LIMIT, TURMA_CHOOSE_TIME, load_turnos, ordem_turmas, turnos
+
+# os testes repetem os mesmos cpfs a partir do mesmo endereco; os limites sao testados a parte
+limites.cpf = None
+limites.endereco = None
 
 def clear_db():
     path = DATA_DIR
@@ -34,8 +48,7 @@ async def populate_db(cadastro_count: int):
 @pytest.mark.asyncio
 async def test_single_user_matricula():
     await populate_db(1)
-    client = TestClient(app)
-    with client.websocket_connect("/ws/matricula/0") as websocket:
+    with TestClient(app) as client, client.websocket_connect("/ws/matricula/0") as websocket:
         websocket.send_text("turno")
         assert websocket.receive_text() == "ok"
         assert websocket.receive_text() == "vez"
@@ -54,8 +67,8 @@ async def test_single_user_matricula():
 @pytest.mark.asyncio
 async def test_double_user_matricula_all_matutino():
     await populate_db(2)
-    client = TestClient(app)
-    with client.websocket_connect("/ws/matricula/0") as ws1:
+    # o TestClient roda o lifespan do app, que prende os dispatchers ao loop dele
+    with TestClient(app) as client, client.websocket_connect("/ws/matricula/0") as ws1:
         with client.websocket_connect("/ws/matricula/1") as ws2:
             ws1.send_text("turno")
             assert ws1.receive_text() == "ok"
@@ -105,3 +118,747 @@ async def test_cadastro():
         for i in range(CADASTRO_COUNT):
             response = await ac.post(CADASTRO_ROUTE + str(i))
             assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_vagas_persistidas_no_arquivo():
+    await populate_db(CADASTRO_COUNT)
+    await storage.compact()
+
+    for nome in ["matutino", "vespertino"]:
+        with open(path_from_turno(nome)) as f:
+            assert f.read() == vagas.get(nome).to_string()
+
+    assert sum(t.verde for t in vagas.get("matutino").turmas) == 6
+    assert sum(t.verde for t in vagas.get("vespertino").turmas) == 4
+
+
+@pytest.mark.asyncio
+async def test_journal_reconstroi_estado():
+    await populate_db(CADASTRO_COUNT)
+    with TestClient(app) as client, client.websocket_connect("/ws/matricula/0") as websocket:
+        websocket.send_text("turno")
+        assert websocket.receive_text() == "ok"
+        assert websocket.receive_text() == "vez"
+        websocket.send_text("matutino")
+        assert websocket.receive_text() == "ok"
+        assert websocket.receive_text() == "vez"
+        websocket.send_text("turma: C")
+        assert websocket.receive_text() == "ok"
+
+    with open(JOURNAL_FILE_PATH) as f:
+        assert len(f.read().split("\n")) == CADASTRO_COUNT + 2
+
+    turnos = {path: turno.to_string() for path, turno in vagas.turnos.items()}
+    start_db()
+    assert {path: turno.to_string() for path, turno in vagas.turnos.items()} == turnos
+    assert storage.get_aluno("0").turma == "C"
+    assert storage.count_alunos() == CADASTRO_COUNT
+    assert not os.path.exists(JOURNAL_FILE_PATH) or os.path.getsize(JOURNAL_FILE_PATH) == 0
+
+
+class AsgiWebSocket:
+    """Cliente websocket que fala ASGI direto com o app, no mesmo event loop do teste"""
+    def __init__(self, path: str):
+        self.path, _, self.query = path.partition("?")
+        self.to_app: asyncio.Queue = asyncio.Queue()
+        self.from_app: asyncio.Queue = asyncio.Queue()
+
+    async def start(self) -> dict:
+        """Conecta e devolve a resposta do app: websocket.accept ou websocket.close"""
+        scope = {
+            "type": "websocket", "path": self.path, "raw_path": self.path.encode(),
+            "root_path": "", "scheme": "ws", "query_string": self.query.encode(), "headers": [],
+            "client": ("test", 0), "server": ("test", 80), "subprotocols": [],
+        }
+        self.task = asyncio.create_task(app(scope, self.to_app.get, self.from_app.put))
+        await self.to_app.put({"type": "websocket.connect"})
+        return await self.from_app.get()
+
+    async def __aenter__(self):
+        message = await self.start()
+        assert message["type"] == "websocket.accept"
+        return self
+
+    async def __aexit__(self, *args):
+        await self.to_app.put({"type": "websocket.disconnect", "code": 1000})
+        await self.task
+
+    async def send_text(self, data: str):
+        await self.to_app.put({"type": "websocket.receive", "text": data})
+
+    async def receive_text(self) -> str:
+        message = await self.from_app.get()
+        assert message["type"] == "websocket.send"
+        return message["text"]
+
+
+STRESS_COUNT = 400
+
+@pytest.mark.asyncio
+async def test_matricula_concorrente_nao_excede_vagas():
+    await populate_db(STRESS_COUNT)
+    capacidade = {t.name: t.verde for turno in vagas.turnos.values() for t in turno.turmas}
+
+    async def matricula(cpf: int) -> str | None:
+        turno, turmas = ("matutino", turnos["matutino"]) if cpf % 2 == 0 else ("vespertino", turnos["vespertino"])
+        async with AsgiWebSocket(f"/ws/matricula/{cpf}") as websocket:
+            await websocket.send_text("turno")
+            assert await websocket.receive_text() == "ok"
+            assert await websocket.receive_text() == "vez"
+            await websocket.send_text(turno)
+            assert await websocket.receive_text() == "ok"
+            assert await websocket.receive_text() == "vez"
+            # todos disputam a primeira turma do turno
+            for turma in turmas:
+                await websocket.send_text(f"turma:{turma}")
+                if await websocket.receive_text() == "ok":
+                    return turma
+        return None
+
+    escolhas = await asyncio.wait_for(asyncio.gather(*[matricula(cpf) for cpf in range(STRESS_COUNT)]), 30)
+
+    assert None not in escolhas
+    for turno in vagas.turnos.values():
+        for t in turno.turmas:
+            assert t.vermelho <= capacidade[t.name]
+            assert t.vermelho == escolhas.count(t.name)
+            assert t.verde + t.vermelho == capacidade[t.name]
+
+
+class FakeSocket:
+    def __init__(self):
+        self.messages: list[str] = []
+        self.closed = False
+
+    async def send_text(self, data: str):
+        if self.closed:
+            raise RuntimeError("socket fechado")
+        self.messages.append(data)
+
+    async def accept(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_coordenacao_sqlite_fila_global(tmp_path):
+    shared = SqliteStorage(str(tmp_path / "alunos.sqlite"))
+    shared.load()
+    await shared.cadastro("1", ordem_turmas)
+    path = str(tmp_path / "coordination.sqlite")
+    worker1 = ConnectionManager(SqliteCoordination(path, worker="w1"))
+    worker2 = ConnectionManager(SqliteCoordination(path, worker="w2"))
+    vagas.share(shared)
+    try:
+        a = ClientConnection(socket=FakeSocket(), cpf="a")
+        b = ClientConnection(socket=FakeSocket(), cpf="b")
+        # um worker ocioso alem do timeout nao pode perder o cliente que acabou de entrar
+        with worker2.coordination.transaction() as db:
+            db.execute("UPDATE worker SET seen = 0 WHERE id = 'w2'")
+        await worker2.matricula_turno(b)
+        await worker1.matricula_turno(a)
+
+        # so ha uma vaga: o primeiro da fila global e admitido, em qualquer worker
+        await worker1.turno.check()
+        await worker2.turno.check()
+        await b.flush()
+        assert b.socket.messages == ["ok", "vez"]
+        assert a.socket.messages == ["ok"]
+        assert await worker1.turno.contains(b) and await worker2.turno.is_choosing(b)
+
+        await worker1.matricula_turno(b)
+        await b.flush()
+        assert b.socket.messages[-1].startswith("error:")
+
+        await worker2.turno.remove(b)
+        await worker1.turno.check()
+        await a.flush()
+        assert a.socket.messages == ["ok", "vez"]
+        assert await worker2.turno.is_choosing(a)
+        await worker1.turno.remove(a)
+    finally:
+        vagas.source = None
+        start_db()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_storage(tmp_path):
+    path = str(tmp_path / "alunos.sqlite")
+    sqlite_storage = SqliteStorage(path)
+    try:
+        sqlite_storage.load()
+        for i in range(CADASTRO_COUNT):
+            assert await sqlite_storage.cadastro(str(i), ordem_turmas) == ordem_turmas[i % len(ordem_turmas)]
+        assert await sqlite_storage.cadastro("0", ordem_turmas) is None
+        assert sqlite_storage.count_alunos() == CADASTRO_COUNT
+
+        assert await sqlite_storage.matricula("0", "A")
+        assert not await sqlite_storage.matricula("0", "A")
+        assert await sqlite_storage.matricula("1", "A")
+        assert not await sqlite_storage.matricula("2", "A")
+
+        reloaded = SqliteStorage(path)
+        reloaded.load()
+        assert reloaded.get_aluno("0").turma == "A"
+        assert reloaded.get_aluno("2").turma == "X"
+        assert not reloaded.exists(str(CADASTRO_COUNT))
+        assert (await reloaded.aluno("0")).turma == "A"
+        assert await reloaded.aluno(str(CADASTRO_COUNT)) is None
+        assert [cpfs async for cpfs in reloaded.alunos_da_turma("A", lote=1)] == [["0"], ["1"]]
+        assert vagas.turma("A").to_string() == "A 0 2"
+        assert vagas.turma("B").to_string() == "B 2 0"
+    finally:
+        start_db()
+
+
+@pytest.mark.asyncio
+async def test_relatorio_por_turma():
+    await populate_db(10)
+    for cpf, turma in [("3", "A"), ("1", "B"), ("0", "B")]:
+        assert await storage.matricula(cpf, turma)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/api/relatorio")
+        assert response.headers["content-type"].startswith("text/csv")
+        assert response.text == "turma,cpf\nA,3\nB,0\nB,1\n"
+
+        response = await ac.get("/api/relatorio", params={"formato": "ndjson"})
+        assert [json.loads(line) for line in response.text.splitlines()] == [
+            {"turma": "A", "cpf": "3"}, {"turma": "B", "cpf": "0"}, {"turma": "B", "cpf": "1"},
+        ]
+        assert (await ac.get("/api/relatorio", params={"formato": "xml"})).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_sequencia_de_cadastro_sobrevive_reinicio():
+    await populate_db(3)
+    start_db()
+    assert storage.count_alunos() == 3
+    assert await storage.cadastro("3", ordem_turmas) == ordem_turmas[3]
+    assert vagas.turma(ordem_turmas[3]).verde == 1
+
+
+@pytest.mark.asyncio
+async def test_api_vagas():
+    await populate_db(CADASTRO_COUNT)
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        assert (await ac.get("/api/vagas/turno")).json() == {"matutino": 6, "vespertino": 4}
+        assert (await ac.get("/api/vagas/matutino")).json() == {"A": 2, "B": 2, "C": 1, "D": 1}
+        assert (await ac.get("/api/vagas/vespertino")).json() == {"E": 1, "F": 1, "G": 1, "H": 1}
+        assert (await ac.get("/api/vagas/noturno")).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_cadastro_lote():
+    await populate_db(2)
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post("/api/cadastro", json=["1", "2", "3", "3", "../x"])
+        assert response.status_code == 201
+        assert response.json() == {"cadastrados": 2, "duplicados": ["1", "3"], "invalidos": ["../x"]}
+
+        response = await ac.post("/api/cadastro", content="4\n5\n\n6\n2\n")
+        assert response.status_code == 201
+        assert response.json() == {"cadastrados": 3, "duplicados": ["2"], "invalidos": []}
+
+        response = await ac.post("/api/cadastro", json=[None, True, 1.5, 7, "x.tmp"])
+        assert response.json() == {"cadastrados": 1, "duplicados": [], "invalidos": [None, True, 1.5, "x.tmp"]}
+
+        async def pedacos():
+            # o "é" chega dividido entre dois pedacos
+            yield b"8\n\xc3"
+            yield b"\xa9\n9\n"
+        response = await ac.post("/api/cadastro", content=pedacos())
+        assert response.json() == {"cadastrados": 2, "duplicados": [], "invalidos": ["\u00e9"]}
+
+        response = await ac.post("/api/cadastro", content=b"10\n\xff\n")
+        assert response.status_code == 400
+
+    assert storage.count_alunos() == 10
+    # mesmo rodizio do cadastro individual: A, B, C, D, E, F, G, H, A, B
+    assert [t.verde for t in vagas.get("matutino").turmas] == [2, 2, 1, 1]
+    assert [t.verde for t in vagas.get("vespertino").turmas] == [1, 1, 1, 1]
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_admite_quando_vagas_abrem():
+    reset_db()
+    manager = ConnectionManager()
+    vagas.listeners.append(manager.notify_all)
+    try:
+        clients = [ClientConnection(socket=FakeSocket(), cpf=str(i)) for i in range(3)]
+        for client in clients:
+            await manager.matricula_turno(client)
+        dispatcher = manager.turno.dispatcher.task
+        await asyncio.sleep(0.01)
+        assert [c.socket.messages for c in clients] == [["ok"], ["ok"], ["ok"]]
+
+        # o cadastro abre vagas e acorda o mesmo dispatcher, sem tarefas novas por cliente
+        await storage.cadastro_lote(["10", "11"], ordem_turmas)
+        await asyncio.sleep(0.01)
+        assert [c.socket.messages for c in clients] == [["ok", "vez"], ["ok", "vez"], ["ok"]]
+        assert manager.turno.dispatcher.task is dispatcher
+        assert manager.turno.admissions.total == 2
+        assert manager.turno.admissions.rate() > 0
+    finally:
+        vagas.listeners.remove(manager.notify_all)
+
+
+@pytest.mark.asyncio
+async def test_cadastro_individual_acorda_dispatcher():
+    reset_db()
+    manager = ConnectionManager()
+    vagas.listeners.append(manager.notify_all)
+    try:
+        clients = [ClientConnection(socket=FakeSocket(), cpf=str(i)) for i in range(3)]
+        for client in clients:
+            await manager.matricula_turno(client)
+            await client.flush()
+        # o primeiro cai sem desconectar; o envio do "vez" falha para ele
+        clients[0].socket.closed = True
+
+        async with AsyncClient(
+            transport=ASGITransport(app=app), base_url="http://test"
+        ) as ac:
+            for cpf in ["10", "11", "12"]:
+                assert (await ac.post(f"/api/cadastro/{cpf}")).status_code == 201
+        await asyncio.sleep(0.01)
+        assert [c.socket.messages for c in clients] == [["ok"], ["ok", "vez"], ["ok", "vez"]]
+        assert not await manager.turno.contains(clients[0])
+        assert manager.turno.choosing == 2
+        assert not manager.turno.dispatcher.task.done()
+    finally:
+        vagas.listeners.remove(manager.notify_all)
+
+
+@pytest.mark.asyncio
+async def test_quem_sai_da_fila_nao_ocupa_vaga():
+    await populate_db(1)
+    manager = ConnectionManager()
+    escolhendo, saiu, esperando = [ClientConnection(socket=FakeSocket(), cpf=str(i)) for i in range(3)]
+    for client in [escolhendo, saiu, esperando]:
+        await manager.matricula_turno(client)
+    await asyncio.sleep(0.01)
+    await manager.disconnect(saiu)
+    assert manager.turno.counts() == (1, 1)
+
+    await manager.turno.remove(escolhendo)
+    await asyncio.sleep(0.01)
+    await esperando.flush()
+    # a vaga vai para quem ainda esta conectado, nao para o socket que saiu
+    assert esperando.socket.messages == ["ok", "vez"]
+    assert "vez" not in saiu.socket.messages
+    assert manager.turno.counts() == (0, 1)
+    assert manager.deadlines.remaining((manager.turno, saiu)) is None
+
+
+@pytest.mark.asyncio
+async def test_filas_sobrevivem_reinicio(tmp_path):
+    # o turno admite um por vez: 0 escolhe o matutino e 1-4 esperam
+    await populate_db(5)
+    antes = ConnectionManager()
+    clients = [ClientConnection(socket=FakeSocket(), cpf=str(i), resumable=True) for i in range(5)]
+    for client in clients:
+        antes.sessions[client.cpf] = client
+        await antes.matricula_turno(client)
+    await asyncio.sleep(0.01)
+    await antes.matricula_no_turno(clients[0], "matutino")
+    await asyncio.sleep(0.01)
+    estado_path = str(tmp_path / "estado")
+    await Curso("", vagas, storage, antes, ordem_turmas, estado_path=estado_path).save_state()
+    antes.stop()
+
+    depois = ConnectionManager()
+    depois.grace_time = 0.05
+    await Curso("", vagas, storage, depois, ordem_turmas, estado_path=estado_path).restore_state()
+    assert not os.path.exists(estado_path)
+    estado = depois.snapshot()["turnos"]
+    assert estado["turno"] == {"fila": ["1", "2", "3", "4"], "escolhendo": {"0": None}}
+    assert 50 < estado["matutino"]["escolhendo"]["0"] <= TURMA_CHOOSE_TIME
+
+    # quem reconecta recebe de novo a vez; quem nao volta no prazo sai da fila
+    socket = FakeSocket()
+    assert await depois.connect(socket, "0") is depois.sessions["0"]
+    await asyncio.sleep(0.1)
+    await depois.sessions["0"].flush()
+    assert socket.messages == ["vez"]
+    assert list(depois.sessions) == ["0"]
+    assert depois.turno.counts() == (0, 1)
+    depois.stop()
+
+
+@pytest.mark.asyncio
+async def test_prazos_de_escolha():
+    await populate_db(1)
+    manager = ConnectionManager()
+    manager.turno.choose_time = 0.05
+
+    expira = ClientConnection(socket=FakeSocket(), cpf="x")
+    await manager.matricula_turno(expira)
+    await asyncio.sleep(0.01)
+    assert expira.socket.messages == ["ok", "vez"]
+    assert manager.deadlines.remaining((manager.turno, expira)) > 0
+    await asyncio.sleep(0.1)
+    assert expira.socket.messages == ["ok", "vez", "remove"]
+    assert len(manager.deadlines.deadlines) == 0
+    assert len(manager.deadlines.running) == 0
+
+    matricula = ClientConnection(socket=FakeSocket(), cpf="0")
+    await manager.matricula_turno(matricula)
+    await asyncio.sleep(0.01)
+    await manager.matricula_no_turno(matricula, "matutino")
+    await asyncio.sleep(0.01)
+    # o prazo do turno fica suspenso enquanto o do matutino corre
+    assert manager.deadlines.remaining((manager.turno, matricula)) is None
+    assert manager.deadlines.remaining((manager.turnos["matutino"], matricula)) > 0
+    await manager.matricula_turma(matricula, "A")
+    await matricula.flush()
+    assert matricula.socket.messages == ["ok", "vez", "ok", "vez", "ok", "remove", "remove"]
+    assert len(manager.deadlines.deadlines) == 0
+
+
+@pytest.mark.asyncio
+async def test_ws_vagas_envia_mudancas_agrupadas():
+    await populate_db(2)
+    interval = manager.vagas_broadcaster.interval
+    manager.vagas_broadcaster.interval = 0.2
+    try:
+        async with AsgiWebSocket("/ws/vagas") as ws:
+            inicial = json.loads(await ws.receive_text())["vagas"]
+            assert inicial == {"A": 1, "B": 1, "C": 0, "D": 0, "E": 0, "F": 0, "G": 0, "H": 0}
+
+            for cpf in ["2", "3", "4"]:
+                await storage.cadastro(cpf, ordem_turmas)
+
+            # dentro do intervalo do cliente as tres mudancas viram uma mensagem so com as turmas alteradas
+            mensagem = json.loads(await asyncio.wait_for(ws.receive_text(), 1))["vagas"]
+            assert mensagem == {"C": 1, "D": 1, "E": 1}
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(ws.receive_text(), 0.3)
+
+            await storage.cadastro("5", ordem_turmas)
+            assert json.loads(await asyncio.wait_for(ws.receive_text(), 1))["vagas"] == {"F": 1}
+    finally:
+        manager.vagas_broadcaster.interval = interval
+    assert len(manager.vagas_broadcaster.subscribers) == 0
+
+
+def test_fila_posicao():
+    fila = Fila()
+    for i in range(3000):
+        fila.append(i)
+    assert fila.position(0) == 1 and fila.position(2999) == 3000
+    for i in range(2000):
+        assert fila.popleft() == i
+    # passou da metade: os indices foram renumerados
+    assert len(fila.items) < 3000
+    assert fila.position(2000) == 1 and fila.position(2999) == 1000
+    assert fila.position(0) is None
+    assert list(fila)[:2] == [2000, 2001] and len(fila) == 1000
+
+
+@pytest.mark.asyncio
+async def test_posicao_e_eta_para_quem_espera():
+    reset_db()
+    manager = ConnectionManager()
+    manager.turno.tick_time = 0.02
+    vagas.listeners.append(manager.notify_all)
+    try:
+        clients = [ClientConnection(socket=FakeSocket(), cpf=str(i)) for i in range(3)]
+        for client in clients:
+            await manager.matricula_turno(client)
+        await asyncio.sleep(0.05)
+        assert [c.socket.messages for c in clients] == [["ok", f"posicao:{i + 1} eta:?"] for i in range(3)]
+
+        # uma admissao em 10s de janela: 0.1 por segundo
+        await storage.cadastro("10", ordem_turmas)
+        await asyncio.sleep(0.05)
+        assert clients[0].socket.messages[-1] == "vez"
+        assert clients[1].socket.messages[-1] == "posicao:1 eta:10"
+        assert clients[2].socket.messages[-1] == "posicao:2 eta:20"
+
+        # so quem mudou de posicao recebe de novo
+        await asyncio.sleep(0.05)
+        assert len(clients[2].socket.messages) == 3
+
+        await manager.posicao(clients[2])
+        await clients[2].flush()
+        assert clients[2].socket.messages[-1] == "posicao:2 eta:20"
+        await manager.posicao(clients[0])
+        await clients[0].flush()
+        assert clients[0].socket.messages[-1].startswith("error:")
+    finally:
+        vagas.listeners.remove(manager.notify_all)
+
+
+@pytest.mark.asyncio
+async def test_protocolo_json_com_pedidos_em_lote(monkeypatch):
+    await populate_db(1)
+    leituras = []
+    aluno = storage.aluno
+    async def contar(cpf):
+        leituras.append(cpf)
+        return await aluno(cpf)
+    monkeypatch.setattr(storage, "aluno", contar)
+
+    async with AsgiWebSocket("/ws/matricula/0?protocolo=json") as websocket:
+        async def respostas(n: int) -> list[tuple]:
+            mensagens = [json.loads(await websocket.receive_text()) for _ in range(n)]
+            assert all(m["v"] == 1 for m in mensagens)
+            return [(m["id"], m["tipo"], m.get("erro")) for m in mensagens]
+
+        # os dois pedidos vao juntos; o segundo chega antes da vez e a resposta leva o id dele
+        await websocket.send_text(json.dumps([
+            {"v": 1, "id": 1, "comando": "turno"},
+            {"v": 1, "id": "b", "comando": "matutino"},
+        ]))
+        assert await respostas(3) == [(1, "ok", None), ("b", "erro", "nao esta na sua vez"), (None, "vez", None)]
+
+        await websocket.send_text("turno")
+        await websocket.send_text(json.dumps({"v": 2, "id": 2, "comando": "matutino"}))
+        assert await respostas(2) == [(None, "erro", "json invalido"), (None, "erro", "versao nao suportada 2")]
+
+        await websocket.send_text(json.dumps({"v": 1, "id": 3, "comando": "matutino"}))
+        assert await respostas(2) == [(3, "ok", None), (None, "vez", None)]
+        await websocket.send_text(json.dumps({"v": 1, "id": 4, "comando": "turma", "turma": "A"}))
+        assert await respostas(3) == [(4, "ok", None), (None, "remove", None), (None, "remove", None)]
+
+        # a matricula feita fica na conexao: o proximo pedido fecha o socket sem reler o aluno
+        await websocket.send_text(json.dumps({"v": 1, "id": 5, "comando": "posicao"}))
+        message = await websocket.from_app.get()
+        assert message["type"] == "websocket.close" and message["reason"] == "CPF ja foi matriculado"
+    assert leituras == ["0"]
+
+
+@pytest.mark.asyncio
+async def test_limites_recusam_sem_ler_o_armazenamento(monkeypatch):
+    reset_db()
+    leituras = []
+    aluno = storage.aluno
+    async def contar(cpf):
+        leituras.append(cpf)
+        return await aluno(cpf)
+    monkeypatch.setattr(storage, "aluno", contar)
+    monkeypatch.setattr(limites, "cpf", TokenBucket(1, 2))
+    monkeypatch.setattr(limites, "endereco", TokenBucket(1, 4))
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        assert [(await ac.post("/api/cadastro/1")).status_code for _ in range(3)] == [201, 404, 429]
+        assert (await ac.post("/api/cadastro/2")).status_code == 201
+        response = await ac.get("/api/vagas/turno")
+        assert response.status_code == 429 and response.headers["retry-after"] == "1"
+
+    # o segundo websocket passa do limite e e fechado antes de o cpf ser lido
+    monkeypatch.setattr(limites, "cpf", None)
+    monkeypatch.setattr(limites, "endereco", None)
+    monkeypatch.setattr(limites, "max_websockets", 1)
+    async with AsgiWebSocket("/ws/matricula/1"):
+        recusado = AsgiWebSocket("/ws/matricula/2")
+        message = await recusado.start()
+        assert message["type"] == "websocket.close" and message["code"] == 1013
+        await recusado.task
+    assert leituras == ["1"]
+    assert limites.websockets == 0
+    assert 'matricula_recusados_total{motivo="websockets"}' in registry.render()
+
+
+@pytest.mark.asyncio
+async def test_reconexao_mantem_lugar_na_fila():
+    # A, B, C, D, E: o turno admite um por vez (min de 4 e 1)
+    await populate_db(5)
+    async with AsgiWebSocket("/ws/matricula/0") as ws0:
+        await ws0.send_text("turno")
+        assert await ws0.receive_text() == "ok"
+        assert await ws0.receive_text() == "vez"
+
+        async with AsgiWebSocket("/ws/matricula/1") as ws1:
+            await ws1.send_text("turno")
+            assert await ws1.receive_text() == "ok"
+        assert isinstance(manager.sessions["1"].socket, BufferedSocket)
+
+        # o vespertino lota e o turno passa a admitir pelo matutino: o "vez" do cpf 1 fica guardado
+        await ws0.send_text("vespertino")
+        assert await ws0.receive_text() == "ok"
+        assert await ws0.receive_text() == "vez"
+        await ws0.send_text("turma:E")
+        assert await ws0.receive_text() == "ok"
+
+    async with AsgiWebSocket("/ws/matricula/1") as ws1:
+        assert await ws1.receive_text() == "vez"
+        assert not isinstance(manager.sessions["1"].socket, BufferedSocket)
+        await ws1.send_text("matutino")
+        assert await ws1.receive_text() == "ok"
+        assert await ws1.receive_text() == "vez"
+        await ws1.send_text("turma:A")
+        assert await ws1.receive_text() == "ok"
+
+    grace_time = manager.grace_time
+    manager.grace_time = 0.02
+    try:
+        async with AsgiWebSocket("/ws/matricula/2") as ws2:
+            await ws2.send_text("turno")
+            assert await ws2.receive_text() == "ok"
+            assert await ws2.receive_text() == "vez"
+        # o "vez" ja tinha sido entregue ao socket antigo: quem volta escolhendo recebe de novo
+        async with AsgiWebSocket("/ws/matricula/2") as ws2:
+            assert await ws2.receive_text() == "vez"
+        client = manager.sessions["2"]
+        await asyncio.sleep(0.05)
+        # passou o prazo: sai das filas e libera a vez
+        assert "2" not in manager.sessions
+        assert not await manager.turno.contains(client)
+    finally:
+        manager.grace_time = grace_time
+
+
+@pytest.mark.asyncio
+async def test_metrics():
+    await populate_db(1)
+    with TestClient(app) as client:
+        with client.websocket_connect("/ws/matricula/0") as websocket:
+            websocket.send_text("turno")
+            assert websocket.receive_text() == "ok"
+            assert websocket.receive_text() == "vez"
+            websocket.send_text("nada")
+            assert websocket.receive_text().startswith("error:")
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        lines = response.text.split("\n")
+        assert 'matricula_vagas{curso="",turma="A",estado="verde"} 1' in lines
+        assert 'matricula_fila_escolhendo{curso="",turno="turno"} 1' in lines
+        assert 'matricula_fila_esperando{curso="",turno="turno"} 0' in lines
+        assert any(line.startswith('matricula_admissoes_total{curso="",turno="turno"}') for line in lines)
+        assert any(line.startswith('matricula_comando_seconds_count{comando="turno"}') for line in lines)
+        assert any(line.startswith('matricula_comando_seconds_count{comando="desconhecido"}') for line in lines)
+        assert any(line.startswith('matricula_io_seconds_count{op="journal"}') for line in lines)
+
+
+def test_capacidade_incremental():
+    turno = Turno.from_string("A 0 0\nB 2 0\nC 3 0")
+    assert (turno.soma, turno.minimo) == (5, 2)
+    a, b, c = turno.turmas
+    a.abrir_vaga()
+    assert (turno.soma, turno.minimo) == (6, 1)
+    assert a.reservar() and not a.reservar()
+    # a turma com o minimo ficou sem vagas: o minimo passa para a proxima
+    assert (turno.soma, turno.minimo) == (5, 2)
+    b.reservar()
+    b.reservar()
+    c.set(1, 2)
+    assert (turno.soma, turno.minimo) == (1, 1)
+    c.reservar()
+    assert (turno.soma, turno.minimo) == (0, 0)
+
+
+class SlowSocket(FakeSocket):
+    """Socket cujo envio so termina quando o teste libera"""
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+        self.close_code = None
+
+    async def send_text(self, data: str):
+        await self.release.wait()
+        await super().send_text(data)
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+
+@pytest.mark.asyncio
+async def test_cliente_lento_nao_trava_admissoes():
+    await populate_db(2)
+    manager = ConnectionManager()
+    lento = ClientConnection(socket=SlowSocket(), cpf="0", resumable=True)
+    rapido = ClientConnection(socket=FakeSocket(), cpf="1")
+    await manager.matricula_turno(lento)
+    await manager.matricula_turno(rapido)
+    await asyncio.sleep(0.01)
+    await rapido.flush()
+    assert rapido.socket.messages == ["ok", "vez"]
+    assert await manager.turno.is_choosing(lento)
+
+    # fila de saida cheia: as posicoes mais antigas sao descartadas
+    for i in range(OUTBOX_LIMIT * 2):
+        lento.send(f"posicao:{i} eta:?")
+    assert len(lento.outbox) == OUTBOX_LIMIT
+    assert lento.outbox[0] == "vez" and lento.outbox[-1] == f"posicao:{OUTBOX_LIMIT * 2 - 1} eta:?"
+
+    # sem mais nada que possa ser descartado o socket lento e fechado; o que estava na fila espera a reconexao
+    socket = lento.socket
+    for i in range(OUTBOX_LIMIT):
+        lento.send("error: teste")
+    await asyncio.sleep(0.01)
+    assert socket.close_code == 1013
+    assert isinstance(lento.socket, BufferedSocket)
+    assert list(lento.socket.messages)[:2] == ["ok", "vez"]
+    assert len(lento.outbox) == 0
+
+
+def test_turnos_configurados(tmp_path):
+    path = tmp_path / "turnos.json"
+    path.write_text(json.dumps({"turnos": {"manha": ["M1", "M2"], "tarde": ["T1"], "noite": ["N1", "N2", "N3"]}}))
+    turnos, ordem = load_turnos(str(path))
+    assert list(turnos) == ["manha", "tarde", "noite"]
+    assert ordem == ["M1", "M2", "T1", "N1", "N2", "N3"]
+
+    for invalido in [{"turnos": {"posicao": ["A"]}},
+                     {"turnos": {"manha": ["A"], "tarde": ["A"]}},
+                     {"turnos": {"manha": ["X"]}},
+                     {"turnos": {"manha": ["A"]}, "ordem_turmas": ["B"]}]:
+        path.write_text(json.dumps(invalido))
+        with pytest.raises(ValueError):
+            load_turnos(str(path))
+
+
+@pytest.mark.asyncio
+async def test_cursos_independentes():
+    await populate_db(1)
+    os.makedirs(CURSOS_DIR + "engenharia")
+    with open(CURSOS_DIR + "engenharia" + os.sep + "turnos.json", "w") as f:
+        json.dump({"turnos": {"manha": ["M1", "M2"]}}, f)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        assert (await ac.post("/engenharia/api/cadastro/0")).status_code == 201
+        assert (await ac.get("/engenharia/api/vagas/turno")).json() == {"manha": 1}
+        assert (await ac.get("/api/vagas/turno")).json() == {"matutino": 1, "vespertino": 0}
+        assert (await ac.get("/medicina/api/fila")).status_code == 404
+
+        async with AsgiWebSocket("/engenharia/ws/matricula/0") as ws:
+            await ws.send_text("turno")
+            assert await ws.receive_text() == "ok"
+            assert await ws.receive_text() == "vez"
+            await ws.send_text("manha")
+            assert await ws.receive_text() == "ok"
+            assert await ws.receive_text() == "vez"
+            await ws.send_text("turma:M1")
+            assert await ws.receive_text() == "ok"
+        # o cpf 0 do curso padrao continua sem matricula
+        assert (await storage.aluno("0")).turma == "X"
+
+        # ocioso: sai da memoria com os dados no disco e volta no proximo acesso
+        idle_time = cursos.idle_time
+        cursos.idle_time = 0
+        try:
+            await cursos.evict_idle()
+        finally:
+            cursos.idle_time = idle_time
+        assert "engenharia" not in cursos.cursos
+        assert (await ac.get("/engenharia/api/vagas/manha")).json() == {"M1": 0, "M2": 0}
+        assert (await cursos.get("engenharia")).storage.get_aluno("0").turma == "M1"
+    await cursos.stop()
+
+
+def test_simulacao_em_tempo_virtual():
+    import simulacao
+    resultado = simulacao.rodar(simulacao.gerar(200, semente=1))
+    # as chegadas se espalham por minutos de relogio virtual, rodados sem esperar
+    assert resultado["tempo_virtual_s"] > 60
+    assert resultado["tempo_real_s"] < 10
+    assert resultado["admissoes_fora_de_ordem"] == 0
+    assert resultado["desfechos"]["matriculado"] == resultado["vagas_ocupadas"] > 150
+    assert sum(resultado["desfechos"].values()) == 200
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import asyncio, heapq, itertools, time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Hashable
+
+from background import BackgroundTask
+
+
+def monotonic() -> float:
+    """Relogio das filas e prazos: o do event loop, que so difere de time.monotonic() no loop da simulacao"""
+    try:
+        return asyncio.get_running_loop().time()
+    except RuntimeError:
+        return time.monotonic()
+
+
+@dataclass(order=True)
+class Deadline:
+    when: float
+    seq: int
+    key: Hashable = field(compare=False)
+    callback: Callable[[], Awaitable[None]] = field(compare=False)
+    cancelled: bool = field(default=False, compare=False)
+
+
+class DeadlineScheduler:
+    """Prazos de escolha num heap, disparados por uma unica tarefa.
+
+    Cancelar so marca o prazo; ele e descartado quando chega ao topo do heap
+    ou quando os cancelados passam da metade e o heap e reconstruido.
+    """
+    def __init__(self):
+        self.heap: list[Deadline] = []
+        self.deadlines: dict[Hashable, Deadline] = {}
+        self.cancelled = 0
+        self.seq = itertools.count()
+        # o loop so guarda referencias fracas das tarefas
+        self.running: set[asyncio.Task] = set()
+        self.runner = BackgroundTask(self.run)
+
+    def now(self) -> float:
+        return monotonic()
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[[], Awaitable[None]]):
+        self.cancel(key)
+        deadline = Deadline(when=self.now() + delay, seq=next(self.seq), key=key, callback=callback)
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, deadline)
+        self.runner.notify()
+
+    def cancel(self, key: Hashable) -> bool:
+        deadline = self.deadlines.pop(key, None)
+        if deadline is None:
+            return False
+        deadline.cancelled = True
+        self.cancelled += 1
+        if self.cancelled > len(self.heap) // 2:
+            self.heap = [d for d in self.heap if not d.cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+        return True
+
+    def remaining(self, key: Hashable) -> float | None:
+        deadline = self.deadlines.get(key)
+        if deadline is None:
+            return None
+        return max(0.0, deadline.when - self.now())
+
+    def pop_due(self) -> list[Deadline]:
+        due = []
+        now = self.now()
+        while len(self.heap) > 0 and (self.heap[0].cancelled or self.heap[0].when <= now):
+            deadline = heapq.heappop(self.heap)
+            if deadline.cancelled:
+                self.cancelled -= 1
+                continue
+            self.deadlines.pop(deadline.key)
+            due.append(deadline)
+        return due
+
+    async def run(self, wakeup: asyncio.Event):
+        while True:
+            wakeup.clear()
+            for deadline in self.pop_due():
+                task = asyncio.create_task(deadline.callback())
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+
+            timeout = None if len(self.heap) == 0 else max(0.0, self.heap[0].when - self.now())
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
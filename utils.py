@@ -1,21 +1,36 @@
-import aiofiles, aiofiles.os
-from config import ALUNO_DIR
+import json, os, string
+from config import ALUNO_DIR, DATA_DIR
 
-async def file_read(path: str) -> str:
-    async with aiofiles.open(path, mode='r') as f:
-        contents = await f.read()
-    return contents
+def file_write_atomic(path: str, content: str):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
-async def file_write(path: str, content: str):
-    async with aiofiles.open(path, mode='w') as f:
-        await f.write(content)
+def path_from_cpf(cpf: str, aluno_dir: str = ALUNO_DIR) -> str:
+    return aluno_dir + cpf
 
-async def file_exist(path: str):
-    return await aiofiles.os.path.isfile(path)
+def path_from_turno(turno: str, data_dir: str = DATA_DIR) -> str:
+    return data_dir + turno
 
-async def file_count_files_in_dir(path: str) -> int:
-    files = await aiofiles.os.listdir(path)
-    return len(files)
+def cpf_valido(cpf: str) -> bool:
+    """Apenas digitos, "." e "-": o cpf vira nome de arquivo em ALUNO_DIR"""
+    return len(cpf) > 0 and not cpf.startswith(".") and all(c in string.digits or c in ".-" for c in cpf)
 
-def path_from_cpf(cpf: str) -> str:
-    return ALUNO_DIR + cpf
+def cpfs_from_json(content: str | bytes) -> tuple[list[str], list]:
+    """Le um array JSON de cpfs; devolve (cpfs, elementos que nao sao string nem inteiro)"""
+    elementos = json.loads(content)
+    if not isinstance(elementos, list):
+        raise ValueError("esperado um array de cpfs")
+    cpfs = []
+    invalidos = []
+    for cpf in elementos:
+        if isinstance(cpf, str):
+            cpfs.append(cpf)
+        elif isinstance(cpf, int) and not isinstance(cpf, bool):
+            cpfs.append(str(cpf))
+        else:
+            invalidos.append(cpf)
+    return cpfs, invalidos